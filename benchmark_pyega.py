@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_ega_server import parse_size
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+# name -> pyega.py arguments after the global options; {dataset}, {bucket} and {run} (unique per run) are filled in
+SCENARIOS = {
+    'fetch': ['fetch', '{dataset}'],
+    'fetch-jobs': ['fetch', '{dataset}', '--jobs', '4'],
+    'fetch-segments': ['fetch', '{dataset}', '--jobs', '2', '--segments', '4'],
+    'sync': ['sync', '{dataset}', 's3://{bucket}/{run}', '-j', '2', '--upload-jobs', '2', '--decryptor', 'python'],
+    'sync-stream': ['sync', '{dataset}', 's3://{bucket}/{run}', '--stream', '-j', '4'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=60):
+    """Wait until something listens on port, or raise if proc exits first"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('{} exited with {}'.format(proc.args, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Nothing listening on port {} after {} seconds'.format(port, timeout))
+
+
+def time_pyega(args, cwd, env):
+    """Run pyega.py with args in cwd; returns tuple of exit status, wall time in seconds, peak RSS in MB"""
+    cmd = [sys.executable, os.path.join(HERE, 'pyega.py')] + args
+    start = time.time()
+    with open(os.path.join(cwd, 'pyega.log'), 'w') as log:
+        p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        (pid, status, rusage) = os.wait4(p.pid, 0)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    return status, seconds, rusage.ru_maxrss / 1024.0
+
+
+def parse_args():
+    """
+    Parse the command-line arguments
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark pyega.py fetch and sync against local EGA and S3 stand-ins")
+    parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS),
+                        help='Scenarios to run, of {} (default: all)'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('-n', '--files', help='Files in the mock dataset', type=int, default=8)
+    parser.add_argument('-s', '--file-size', help='Size of every file, e.g. 256M', default='64M')
+    parser.add_argument('-r', '--repeat', help='Runs per scenario; the fastest is reported', type=int, default=1)
+    parser.add_argument('--encrypted', help='Serve encrypted .cip files (needs cryptography)', action='store_true')
+    parser.add_argument('--latency', help='Seconds the mock EGA adds to every request', default='0')
+    parser.add_argument('--bandwidth', help='Per-connection download cap of the mock EGA, e.g. 50M', default='0')
+    parser.add_argument('--no-range', help='Mock EGA ignores Range headers', action='store_true')
+    parser.add_argument('--fail-rate', help='Fraction of downloads the mock EGA answers with 503', default='0')
+    parser.add_argument('--keep', help='Keep downloads and logs under this directory', type=str, default=None)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+    return args
+
+
+def main():
+    args = parse_args()
+    work_dir = args.keep or tempfile.mkdtemp(prefix='pyega_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Isolated HOME for ~/.ega.json and the listing cache, and dummy credentials for the S3 stand-in
+    home = os.path.join(work_dir, 'home')
+    os.makedirs(home, exist_ok=True)
+    with open(os.path.join(home, '.ega.json'), 'w') as fo:
+        json.dump({'username': 'bench', 'password': 'bench', 'key': 'benchkey'}, fo)
+    env = dict(os.environ, HOME=home, AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench',
+               AWS_DEFAULT_REGION='us-east-1')
+
+    ega_port = free_port()
+    ega_cmd = [sys.executable, os.path.join(HERE, 'mock_ega_server.py'), '-p', str(ega_port),
+               '-n', str(args.files), '-s', args.file_size, '--latency', args.latency,
+               '--bandwidth', args.bandwidth, '--fail-rate', args.fail_rate]
+    ega_cmd += ['--encrypted'] if args.encrypted else []
+    ega_cmd += ['--no-range'] if args.no_range else []
+    servers = [subprocess.Popen(ega_cmd, env=env, stdout=subprocess.DEVNULL)]
+
+    try:
+        wait_for_port(ega_port, servers[0])
+        base_args = ['--base-url', 'http://127.0.0.1:{}/ega/rest'.format(ega_port), '--cache-ttl', '0']
+
+        if any(name.startswith('sync') for name in args.scenarios):
+            import boto3
+            s3_port = free_port()
+            servers.append(subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(s3_port)], env=env,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            wait_for_port(s3_port, servers[-1])
+            s3_endpoint = 'http://127.0.0.1:{}'.format(s3_port)
+            boto3.client('s3', endpoint_url=s3_endpoint, aws_access_key_id='bench', aws_secret_access_key='bench',
+                         region_name='us-east-1').create_bucket(Bucket='pyega-bench')
+            base_args += ['--s3-endpoint-url', s3_endpoint]
+
+        total_mb = args.files * parse_size(args.file_size) / 1024.0 / 1024.0
+        print('{} files, {:.0f} MB in total'.format(args.files, total_mb))
+        print('{:>16} {:>10} {:>10} {:>12} {:>8}'.format('scenario', 'seconds', 'MB/s', 'peak RSS MB', 'status'))
+        for name in args.scenarios:
+            runs = []
+            for i in range(args.repeat):
+                run = '{}_{}'.format(name, i)
+                cwd = os.path.join(work_dir, run)
+                os.makedirs(cwd, exist_ok=True)
+                # A fresh S3 prefix per run, so that sync never skips files uploaded by an earlier run
+                scenario_args = [a.format(dataset='EGAD00000000001', bucket='pyega-bench', run=run)
+                                 for a in SCENARIOS[name]]
+                runs.append(time_pyega(base_args + scenario_args, cwd, env))
+            (status, seconds, peak_rss) = min(runs, key=lambda run: (run[0] != 0, run[1]))
+            print('{:>16} {:>10.2f} {:>10.1f} {:>12.1f} {:>8}'.format(
+                name, seconds, total_mb / seconds, peak_rss, 'ok' if status == 0 else 'FAILED'))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def write_metadata(metadata_dir, nsamples, files_per_sample=2, samples_per_xml=1000, nattributes=5, seed=0):
+    """
+    Write a synthetic EGA metadata package with nsamples samples to metadata_dir
+
+    Samples are spread over xmls/samples/*.xml files of samples_per_xml samples each,
+    and delimited_maps/Sample_File.map maps files_per_sample files to every sample,
+    in shuffled order.
+    """
+    rng = random.Random(seed)
+    samples_dir = os.path.join(metadata_dir, 'xmls', 'samples')
+    maps_dir = os.path.join(metadata_dir, 'delimited_maps')
+    os.makedirs(samples_dir)
+    os.makedirs(maps_dir)
+
+    for first in range(0, nsamples, samples_per_xml):
+        with open(os.path.join(samples_dir, 'samples_{:08d}.xml'.format(first)), 'w') as fo:
+            fo.write('<SAMPLE_SET>\n')
+            for i in range(first, min(first + samples_per_xml, nsamples)):
+                fo.write('<SAMPLE alias="sample_{0}" accession="EGAN{0:011d}">'.format(i))
+                fo.write('<IDENTIFIERS><PRIMARY_ID>EGAN{0:011d}</PRIMARY_ID>'
+                         '<SUBMITTER_ID namespace="bench">submitter_{0}</SUBMITTER_ID></IDENTIFIERS>'.format(i))
+                fo.write('<SAMPLE_NAME><COMMON_NAME>human</COMMON_NAME></SAMPLE_NAME><SAMPLE_ATTRIBUTES>')
+                for a in range(nattributes):
+                    fo.write('<SAMPLE_ATTRIBUTE><TAG>attribute_{}</TAG><VALUE>{}</VALUE></SAMPLE_ATTRIBUTE>'.format(
+                        a, rng.randint(0, 1000000)))
+                fo.write('</SAMPLE_ATTRIBUTES></SAMPLE>\n')
+            fo.write('</SAMPLE_SET>\n')
+
+    lines = ['submitter_{0}\tEGAN{0:011d}\tfile_{0}_{1}.bam\tEGAF{2:011d}\n'.format(i, f, i * files_per_sample + f)
+             for i in range(nsamples) for f in range(files_per_sample)]
+    rng.shuffle(lines)
+    with open(os.path.join(maps_dir, 'Sample_File.map'), 'w') as fo:
+        fo.writelines(lines)
+
+
+def time_reformat(metadata_dir, output_file, extra_args=()):
+    """Run reformat_metadata.py on metadata_dir; returns tuple of wall time in seconds, peak RSS in MB"""
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'reformat_metadata.py')
+    cmd = [sys.executable, script, '-i', metadata_dir, '-u', output_file] + list(extra_args)
+    start = time.time()
+    p = subprocess.Popen(cmd)
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    seconds = time.time() - start
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd)
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, rusage.ru_maxrss / 1024.0
+
+
+def parse_args():
+    """
+    Parse the command-line arguments
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark reformat_metadata.py on synthetic metadata packages")
+    parser.add_argument('-n', '--sizes', help='Numbers of samples to benchmark', type=int, nargs='+',
+                        default=[1000, 2000, 4000, 8000, 16000])
+    parser.add_argument('-f', '--files_per_sample', help='Files mapped to each sample', type=int, default=2)
+    parser.add_argument('-r', '--repeat', help='Runs per size; the fastest is reported', type=int, default=3)
+    parser.add_argument('-s', '--stream', help='Benchmark reformat_metadata.py --stream', action='store_true')
+    parser.add_argument('-w', '--workers', help='Benchmark reformat_metadata.py --workers', type=int, default=1)
+    parser.add_argument('--keep', help='Keep the generated metadata under this directory', type=str, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_dir = args.keep or tempfile.mkdtemp(prefix='reformat_bench_')
+
+    extra_args = ['--stream'] if args.stream else []
+    extra_args += ['--workers', str(args.workers)]
+
+    print('{:>10} {:>10} {:>12} {:>14} {:>12}'.format('samples', 'map lines', 'seconds', 'us per sample',
+                                                      'peak RSS MB'))
+    try:
+        for nsamples in args.sizes:
+            metadata_dir = os.path.join(work_dir, 'metadata_{}'.format(nsamples))
+            if not os.path.exists(metadata_dir):
+                write_metadata(metadata_dir, nsamples, args.files_per_sample)
+            output_file = os.path.join(work_dir, 'output_{}.csv'.format(nsamples))
+
+            (seconds, peak_rss) = min(time_reformat(metadata_dir, output_file, extra_args)
+                                      for _ in range(args.repeat))
+            print('{:>10} {:>10} {:>12.3f} {:>14.1f} {:>12.1f}'.format(
+                nsamples, nsamples * args.files_per_sample, seconds, seconds / nsamples * 1e6, peak_rss))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
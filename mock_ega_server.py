@@ -0,0 +1,311 @@
+"""
+Local stand-in for the EGA REST API, for testing and benchmarking pyega.py without credentials
+
+Implements login/logout, dataset and file listings, requests/new, request listings,
+request deletion and ds/v2/downloads/{ticket}, serving synthetic files of configurable
+size with optional latency, per-connection bandwidth caps, HTTP Range support and
+injected failures. Point pyega.py at it with --base-url http://127.0.0.1:<port>/ega/rest
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # Only needed for --encrypted
+    Cipher = None
+
+BLOCK_SIZE = 1024 * 1024    # synthetic file content repeats a per-file random block of this size
+CIP_SALT = bytes([244, 34, 1, 0, 158, 223, 78, 21])     # as pyega.CipDecryptor / EgaDemoClient.jar
+
+
+class MockFile:
+    """A synthetic file: a per-file pseudo-random block repeated up to size bytes"""
+
+    def __init__(self, file_id, name, size, seed):
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        rng = random.Random("{}-{}".format(seed, file_id))
+        self.block = rng.getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, 'little')
+        self._md5 = None
+
+    def read(self, start, end):
+        """Plaintext bytes [start, end)"""
+        out = bytearray()
+        while start < end:
+            offset = start % BLOCK_SIZE
+            n = min(BLOCK_SIZE - offset, end - start)
+            out += self.block[offset:offset + n]
+            start += n
+        return bytes(out)
+
+    def md5(self):
+        if self._md5 is None:
+            md5 = hashlib.md5()
+            for start in range(0, self.size, BLOCK_SIZE):
+                md5.update(self.read(start, min(start + BLOCK_SIZE, self.size)))
+            self._md5 = md5.hexdigest()
+        return self._md5
+
+
+class MockEga:
+    """State of the mock server: datasets, files, sessions and outstanding request tickets"""
+
+    def __init__(self, nfiles=10, file_size=64 * 1024 * 1024, seed=0, encrypted=False):
+        self.dataset = "EGAD00000000001"
+        self.encrypted = encrypted
+        suffix = ".bam.cip" if encrypted else ".bam"
+        self.files = {}
+        for i in range(nfiles):
+            file_id = "EGAF{:011d}".format(i + 1)
+            self.files[file_id] = MockFile(file_id, "/EGAR{:011d}/sample_{}{}".format(i + 1, i, suffix), file_size, seed)
+        self.sessions = set()
+        self.tickets = {}       # ticket -> (label, file_id, rekey)
+        self.lock = threading.Lock()
+
+    def listing(self, mock_file):
+        return {"fileIndex": "", "fileSize": str(mock_file.size), "fileStatus": "available",
+                "fileName": mock_file.name, "fileDataset": self.dataset, "fileMD5": mock_file.md5(),
+                "fileID": mock_file.file_id}
+
+    def transfer_size(self, ticket):
+        """Bytes served for a ticket: encrypted downloads carry a 16 byte IV before the data"""
+        return self.files[self.tickets[ticket][1]].size + (16 if self.encrypted else 0)
+
+    def transfer_bytes(self, ticket, start, end):
+        """Bytes [start, end) of what is served for a ticket, encrypting on the fly if needed"""
+        (label, file_id, rekey) = self.tickets[ticket]
+        mock_file = self.files[file_id]
+        if not self.encrypted:
+            return mock_file.read(start, end)
+
+        # AES-256-CTR with the IV first; CTR allows starting at any offset for Range requests
+        iv = hashlib.md5(ticket.encode()).digest()
+        head = iv[start:min(end, 16)]
+        start = max(start, 16) - 16
+        end = end - 16
+        if end <= start:
+            return head
+        key = hashlib.pbkdf2_hmac('sha1', rekey.encode(), CIP_SALT, 1024, 32)
+        counter = (int.from_bytes(iv, 'big') + start // 16) % (1 << 128)
+        encryptor = Cipher(algorithms.AES(key), modes.CTR(counter.to_bytes(16, 'big')),
+                           backend=default_backend()).encryptor()
+        skip = start % 16
+        data = encryptor.update(b'\0' * skip + mock_file.read(start, end))[skip:]
+        return head + data
+
+
+class MockEgaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ega = None          # MockEga
+    options = None      # argparse namespace of latency / bandwidth / range / failure settings
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, reply, status=200):
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def ok(self, result, user_message="OK"):
+        self.send_json({"header": {"userMessage": user_message},
+                        "response": {"numTotalResults": len(result), "result": result}})
+
+    def session_ok(self, query):
+        if query.get("session", [""])[0] not in self.ega.sessions:
+            self.ok([], "Invalid session")
+            return False
+        return True
+
+    def do_POST(self):
+        time.sleep(self.options.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+
+        if url.path.endswith("/access/v2/users/login"):
+            session = str(uuid.uuid4())
+            self.ega.sessions.add(session)
+            self.ok(["success", session])
+            return
+
+        m = re.search(r"/access/v2/requests/new/(datasets|files)/([^/]+)$", url.path)
+        if m and self.session_ok(query):
+            # downloadrequest={"rekey":<key>,"downloadType":"STREAM","descriptor":<label>}, values unquoted
+            rekey = re.search(r'"rekey":([^,}]*)', body).group(1).strip('"')
+            label = re.search(r'"descriptor":([^,}]*)', body).group(1).strip('"')
+            (id_type, stable_id) = m.groups()
+            if id_type == "datasets":
+                file_ids = list(self.ega.files) if stable_id == self.ega.dataset else []
+            else:
+                file_ids = [stable_id] if stable_id in self.ega.files else []
+            if not file_ids:
+                self.ok([], "Unknown {}".format(stable_id))
+                return
+            with self.ega.lock:
+                for file_id in file_ids:
+                    self.ega.tickets[str(uuid.uuid4())] = (label, file_id, rekey)
+            self.ok([label])
+        elif not m:
+            self.send_error(404)
+
+    def do_GET(self):
+        time.sleep(self.options.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        m = re.search(r"/ds/v2/downloads/([^/]+)$", url.path)
+        if m:
+            self.download(m.group(1))
+            return
+
+        if url.path.endswith("/access/v2/users/logout"):
+            self.ega.sessions.discard(query.get("session", [""])[0])
+            self.ok([])
+            return
+        if not self.session_ok(query):
+            return
+
+        if url.path.endswith("/access/v2/datasets"):
+            self.ok([self.ega.dataset])
+            return
+
+        m = re.search(r"/access/v2/datasets/([^/]+)/files$", url.path)
+        if m:
+            if m.group(1) != self.ega.dataset:
+                self.ok([], "Unknown dataset")
+            else:
+                self.ok([self.ega.listing(f) for f in self.ega.files.values()])
+            return
+
+        m = re.search(r"/access/v2/requests/delete/([^/]+)$", url.path)
+        if m:
+            with self.ega.lock:
+                for ticket in [t for (t, v) in self.ega.tickets.items() if v[0] == m.group(1)]:
+                    del self.ega.tickets[ticket]
+            self.ok([m.group(1)])
+            return
+
+        m = re.search(r"/access/v2/requests(?:/([^/]+))?$", url.path)
+        if m:
+            with self.ega.lock:
+                tickets = [(t, v) for (t, v) in self.ega.tickets.items() if m.group(1) in (None, v[0])]
+            result = []
+            for (ticket, (label, file_id, rekey)) in tickets:
+                res = self.ega.listing(self.ega.files[file_id])
+                res.update({"ticket": ticket, "label": label})
+                result.append(res)
+            self.ok(result)
+            return
+
+        self.send_error(404)
+
+    def download(self, ticket):
+        if ticket not in self.ega.tickets:
+            self.send_error(404, "Unknown ticket")
+            return
+        if random.random() < self.options.fail_rate:
+            self.send_error(503, "Injected failure")
+            return
+
+        size = self.ega.transfer_size(ticket)
+        (start, end) = (0, size)
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m and not self.options.no_range:
+            start = int(m.group(1))
+            end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        # Send in slices paced to the per-connection bandwidth cap; optionally drop the connection midway
+        slice_size = 256 * 1024
+        cut_at = start + int((end - start) * random.random()) if random.random() < self.options.cut_rate else None
+        began = time.time()
+        sent = 0
+        for offset in range(start, end, slice_size):
+            if cut_at is not None and offset >= cut_at:
+                self.close_connection = True
+                return
+            data = self.ega.transfer_bytes(ticket, offset, min(offset + slice_size, end))
+            self.wfile.write(data)
+            sent += len(data)
+            if self.options.bandwidth:
+                delay = sent / self.options.bandwidth - (time.time() - began)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def parse_size(size):
+    """Parse a byte count with an optional K/M/G suffix (powers of 1024), e.g. 64M"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the EGA REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8099)
+    parser.add_argument("-n", "--files", type=int, default=10, help="Files in the mock dataset EGAD00000000001")
+    parser.add_argument("-s", "--file-size", type=parse_size, default=64 * 1024 * 1024,
+                        help="Size of every file, e.g. 1G (default 64M)")
+    parser.add_argument("--encrypted", action="store_true",
+                        help="Serve .cip files encrypted with the request key, as EGA does (needs cryptography)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--bandwidth", type=parse_size, default=0,
+                        help="Per-connection download cap in bytes/second, e.g. 20M (default: unlimited)")
+    parser.add_argument("--no-range", action="store_true", help="Ignore Range headers on downloads")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Fraction of download requests answered with 503")
+    parser.add_argument("--cut-rate", type=float, default=0.0,
+                        help="Fraction of downloads whose connection is dropped partway")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic file contents")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    if options.encrypted and Cipher is None:
+        quit("--encrypted requires the 'cryptography' module")
+
+    MockEgaHandler.ega = MockEga(options.files, options.file_size, options.seed, options.encrypted)
+    MockEgaHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), MockEgaHandler)
+    print("Mock EGA serving {} files of {} bytes at http://{}:{}/ega/rest".format(
+        options.files, options.file_size, options.host, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,310 @@
 import argparse
+import asyncio
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import functools
+import hashlib
 import json
 import os
+import queue
 import requests
+from requests.adapters import HTTPAdapter
+import shutil
 import subprocess as sub
 import sys
+import threading
+import time
 from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 import uuid
+import zlib
+
+try:
+    import aiohttp
+except ImportError:
+    # Only needed for fetch/resume --async
+    aiohttp = None
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # Only needed to decrypt in-process (sync --stream, sync --decryptor python)
+    Cipher = None
 
 debug = False
 version = "1.1.0"
 
+# EGA REST endpoints; --base-url (or $PYEGA_BASE_URL) points both at another server, e.g. a local mock
+EGA_BASE_URL = "https://ega.ebi.ac.uk/ega/rest"
+api_url = EGA_BASE_URL + "/access/v2"
+download_api_url = "http://ega.ebi.ac.uk/ega/rest/ds/v2"
+s3_endpoint_url = None  # None for AWS itself
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024   # bytes held in memory at once per download stream
+PROGRESS_INTERVAL = 10              # seconds between throughput reports
+DOWNLOAD_RETRIES = 3                # extra attempts per file before giving up on it
+RETRY_BACKOFF = 5                   # seconds before the first retry, doubled after each failure
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024 # files are never split into byte ranges smaller than this
+JOURNAL_INTERVAL = 5                # seconds between transfer journal checkpoints
+STREAM_PART_SIZE = 64 * 1024 * 1024 # S3 multipart part size for sync --stream (max 10,000 parts per object)
+UPLOAD_PART_SIZE = 8 * 1024 * 1024  # smallest S3 multipart part size for sync uploads from local disk
+S3_MAX_PARTS = 10000                # parts allowed per S3 multipart upload
+STREAM_BUFFER_CHUNKS = 16           # download chunks buffered between the download and upload stages
+UPLOAD_CONCURRENCY = 4              # parts of one object uploaded to S3 at a time
+PIPELINE_QUEUE_SIZE = 4             # files waiting between two sync pipeline stages
+REQUEST_CONCURRENCY = 8             # download requests made at once for a --manifest batch
+HTTP_POOL_SIZE = 10                 # keep-alive connections kept open per host
+HTTP_TIMEOUT = (30, 300)            # seconds to (connect, wait for data) before giving up on a request
+HTTP_RETRIES = 3                    # retries of failed connections and 5xx replies, with backoff
+CACHE_DIR = "~/.cache/pyega"        # on-disk cache of listing replies
+CACHE_TTL = 600                     # seconds a cached listing is served before it is fetched again
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # least recently used listings are evicted beyond this
+HTTP_BACKOFF = 1                    # seconds; retry waits grow as backoff * 2 ** (retry - 1)
+EGA_CLIENT_JAR = "/usr/src/app/EgaDemoClient.jar"
+JAR_BATCH_WAIT = 2                  # seconds the batching jar decryptor waits to fill a batch
+METRICS_INTERVAL = 30               # seconds between rewrites of the Prometheus metrics file
+ADAPT_INTERVAL = 5                  # seconds of throughput measured before --adaptive changes concurrency
+STORE_MAX_BYTES = 500 * 1024 ** 3   # least recently used objects are evicted from the --store beyond this
+FICLONE = 0x40049409                # Linux ioctl making a copy-on-write clone (reflink) of a file
+CIP_IV_SIZE = 16                    # bytes of IV that EGA sends before the encrypted data of a .cip file
+SYNC_MANIFEST_NAME = ".pyega-sync.json"     # default sync --incremental manifest, kept under the destination
+
+
+class EgaClient:
+    """HTTP client shared by every EGA API call and download, with pooled connections, timeouts and retries"""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+
+client = EgaClient()
+
+
+def atomic_write(path, data):
+    """Write data (str or bytes) to path via a temporary file renamed over it, so it is never seen half-written"""
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as fo:
+        fo.write(data)
+    os.replace(tmp_path, path)
+
+
+class ListingCache:
+    """
+    On-disk cache of EGA listing replies, keyed by API URL + user + endpoint + identifier
+
+    Entries are served for ttl seconds (any age when offline), and the least recently
+    used are evicted beyond max_bytes.
+    """
+
+    def __init__(self, directory=CACHE_DIR, user="", ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, offline=False,
+                 refresh=False):
+        self.directory = os.path.expanduser(directory)
+        self.user = user
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.refresh = refresh
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def path(self, endpoint, identifier):
+        digest = hashlib.sha1("{}\0{}\0{}\0{}".format(api_url, self.user, endpoint, identifier).encode()).hexdigest()
+        return os.path.join(self.directory, "{}-{}.json.z".format(endpoint, digest))
+
+    def fetch(self, endpoint, identifier, call):
+        """Cached reply for endpoint + identifier, or the reply of call() (which is then cached)"""
+        if not self.refresh:
+            reply = self.get(endpoint, identifier)
+            if reply is not None:
+                if (debug): print("[cache] {} {}".format(endpoint, identifier))
+                return reply
+        if self.offline:
+            print("No cached {} listing {}available offline".format(endpoint, identifier + " " if identifier else ""))
+            sys.exit(1)
+
+        reply = call()
+        self.put(endpoint, identifier, reply)
+        return reply
+
+    def get(self, endpoint, identifier):
+        path = self.path(endpoint, identifier)
+        try:
+            if not self.offline and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                reply = json.loads(zlib.decompress(f.read()).decode())
+            os.utime(path, None)    # access time for LRU eviction
+            return reply
+        except (OSError, ValueError, zlib.error):
+            return None
+
+    def put(self, endpoint, identifier, reply):
+        if self.ttl <= 0:
+            return
+        atomic_write(self.path(endpoint, identifier), zlib.compress(json.dumps(reply, separators=(',', ':')).encode()))
+        self.evict()
+
+    def invalidate(self, endpoint):
+        """Drop every cached listing of an endpoint (e.g. requests, after a request is made or deleted)"""
+        for name in os.listdir(self.directory):
+            if name.startswith(endpoint + "-"):
+                self.remove(os.path.join(self.directory, name))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+            except OSError:
+                pass
+        total = sum(size for (mtime, size, name) in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(os.path.join(self.directory, name))
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+cache = None    # ListingCache set up by main()
+
+
+class Telemetry:
+    """
+    Per-stage events of a run (bytes, seconds, retries, time queued)
+
+    Appended to a JSON-lines report and summed into a Prometheus text file, if paths are given.
+    """
+
+    FIELDS = [('events', 'Events recorded'), ('errors', 'Events that failed'), ('bytes', 'Bytes moved'),
+              ('seconds', 'Seconds spent'), ('retries', 'Retries made'),
+              ('queued_seconds', 'Seconds spent waiting for the stage')]
+
+    def __init__(self, report_path=None, metrics_path=None, metrics_interval=METRICS_INTERVAL):
+        self.report = open(report_path, "a") if report_path else None
+        self.metrics_path = metrics_path
+        self.enabled = bool(report_path or metrics_path)
+        self.start = time.time()
+        self.totals = collections.OrderedDict()     # stage -> {field: total}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if metrics_path:
+            threading.Thread(target=self._write_metrics_periodically, args=(metrics_interval,), daemon=True).start()
+
+    def record(self, stage, seconds, nbytes=0, retries=0, queued=0.0, error=None, **fields):
+        event = {'time': round(time.time(), 3), 'stage': stage, 'seconds': round(seconds, 6), 'bytes': nbytes,
+                 'retries': retries, 'queued_seconds': round(queued, 6), 'ok': error is None, 'error': error}
+        event.update(fields)
+        with self.lock:
+            totals = self.totals.setdefault(stage, dict((field, 0) for (field, help) in self.FIELDS))
+            totals['events'] += 1
+            totals['errors'] += error is not None
+            totals['bytes'] += nbytes
+            totals['seconds'] += seconds
+            totals['retries'] += retries
+            totals['queued_seconds'] += queued
+            if self.report:
+                self.report.write(json.dumps(event) + "\n")
+                self.report.flush()
+
+    def write_metrics(self):
+        lines = ["# HELP pyega_run_start_time_seconds Start of this pyega.py run",
+                 "# TYPE pyega_run_start_time_seconds gauge",
+                 "pyega_run_start_time_seconds {:.3f}".format(self.start)]
+        with self.lock:
+            for (field, help) in self.FIELDS:
+                name = "pyega_stage_{}_total".format(field)
+                lines += ["# HELP {} {} per stage".format(name, help), "# TYPE {} counter".format(name)]
+                for (stage, totals) in self.totals.items():
+                    lines.append('{}{{stage="{}"}} {}'.format(name, stage, round(totals[field], 6)))
+        atomic_write(self.metrics_path, "\n".join(lines) + "\n")
+
+    def _write_metrics_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.write_metrics()
+            except OSError as e:
+                print("Could not write metrics to {}: {}".format(self.metrics_path, e))
+
+    def close(self):
+        """Record the run totals, write the final metrics and print where the time went"""
+        if not self.enabled:
+            return
+        self.stopped.set()
+        with self.lock:
+            stages = dict((stage, dict(totals)) for (stage, totals) in self.totals.items())
+        self.record("run", time.time() - self.start, stages=stages)
+        if self.metrics_path:
+            self.write_metrics()
+        if self.report:
+            self.report.close()
+
+        print("\n{:>10} {:>7} {:>7} {:>8} {:>14} {:>10} {:>10} {:>12}".format(
+            "stage", "events", "errors", "retries", "bytes", "seconds", "queued s", "rate"))
+        for (stage, totals) in self.totals.items():
+            rate = format_rate(totals['bytes'], totals['seconds']) if totals['bytes'] else ""
+            print("{:>10} {:>7} {:>7} {:>8} {:>14} {:>10.1f} {:>10.1f} {:>12}".format(
+                stage, totals['events'], totals['errors'], totals['retries'], totals['bytes'], totals['seconds'],
+                totals['queued_seconds'], rate))
+
+
+telemetry = Telemetry()     # replaced by main() when --report or --metrics-file is given
+
+
+def timed(stage):
+    """Decorator recording each call as a telemetry event of the given stage"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                telemetry.record(stage, time.time() - start, error=str(e), call=fn.__name__)
+                raise
+            telemetry.record(stage, time.time() - start, call=fn.__name__)
+            return result
+        return wrapper
+    return decorator
+
+
+def cached_listing(endpoint):
+    """Decorator serving an api_list_* call from the listing cache, keyed by its arguments after the session"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(session, *args):
+            if cache is None:
+                return fn(session, *args)
+            identifier = "/".join(str(arg) for arg in args)
+            return cache.fetch(endpoint, identifier, lambda: fn(session, *args))
+        return wrapper
+    return decorator
+
 
 def load_credentials(filepath = "~/.ega.json"):
     """Load credentials for EMBL/EBI EGA from ~/.ega.json"""
@@ -27,6 +321,7 @@ def load_credentials(filepath = "~/.ega.json"):
     return (creds['username'], creds['password'], creds['key'])
 
 
+@timed("login")
 def api_login(username, password):
     headers = {'Accept': 'application/json'}
     # This looks horrible, but is necessary for both
@@ -34,9 +329,9 @@ def api_login(username, password):
     # (b) python requests module, which requries a string (vs dict) to post directly and
     # (c) double {{ / }} escaping necessary when using format()
     data = 'loginrequest={{"username": "{}", "password": "{}"}}'.format(username, password)
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/users/login"
+    url = "{}/users/login".format(api_url)
 
-    r = requests.post(url, headers = headers, data = data)
+    r = client.post(url, headers = headers, data = data)
     if (debug): print( json.dumps(r.text, indent=4) ) 
     reply = r.json()
     
@@ -56,17 +351,19 @@ def api_login(username, password):
 
 def api_logout(session):
     headers = {'Accept': 'application/json'}
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/users/logout?session={}".format(session)
-    r = requests.get(url, headers = headers)
+    url = "{}/users/logout?session={}".format(api_url, session)
+    r = client.get(url, headers = headers)
     print("[Logout]")
 
 
+@cached_listing("datasets")
+@timed("listing")
 def api_list_authorized_datasets(session):
     """List datasets to which the credentialed user has authorized access"""
 
     headers = {'Accept':'application/json'}
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/datasets?session={}".format(session)
-    r = requests.get(url, headers = headers)
+    url = "{}/datasets?session={}".format(api_url, session)
+    r = client.get(url, headers = headers)
     reply = r.json()
     if(debug):  print( json.dumps(reply, indent=4) )
     if reply['header']['userMessage'] != "OK":
@@ -84,10 +381,12 @@ def pretty_print_authorized_datasets(reply):
         print(datasetid)
 
 
+@cached_listing("files")
+@timed("listing")
 def api_list_files_in_dataset(session, dataset):
     headers = {'Accept': 'application/json'}
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/datasets/{}/files?session={}".format(dataset, session)
-    r = requests.get(url, headers = headers)
+    url = "{}/datasets/{}/files?session={}".format(api_url, dataset, session)
+    r = client.get(url, headers = headers)
     reply = r.json()
     if(debug):  print( json.dumps(reply, indent=4) )
     if reply['header']['userMessage'] != "OK":
@@ -128,6 +427,8 @@ def pretty_print_files_in_dataset(reply, dataset):
         print(format_string.format( res['fileID'], res['fileIndex'], res['fileStatus'], res['fileSize'], res['fileMD5'], res['fileName'] ) )
 
 
+@cached_listing("requests")
+@timed("listing")
 def api_list_requests(session, req=""):
     """Requests download tickets (optionally for a given request/label)"""
 
@@ -136,12 +437,12 @@ def api_list_requests(session, req=""):
         sys.exit(1)
 
     headers = {'Accept':'application/json'}
-    # URL form with no request label: https://ega.ebi.ac.uk/ega/rest/access/v2/requests?session=<uuid>
-    # URL form with  a request label: https://ega.ebi.ac.uk/ega/rest/access/v2/requests/{reqlabel}?session=<uuid>
+    # URL form with no request label: <api_url>/requests?session=<uuid>
+    # URL form with  a request label: <api_url>/requests/{reqlabel}?session=<uuid>
     if req: req = "/" + req # prepend with / to make url conform to above
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/requests{}?session={}".format(req, session)
+    url = "{}/requests{}?session={}".format(api_url, req, session)
 
-    r = requests.get(url, headers)
+    r = client.get(url, headers = headers)
     reply = r.json()
     if reply['header']['userMessage'] == "OK":
         print("list_requests({}) completed successfully".format(req))
@@ -185,19 +486,23 @@ def pretty_print_files(req_ticket):
         print("{:15} ({:12}) {} {}".format(remote_fileid, remote_filesize, download_ticket, remote_filename))
 
 
-def api_delete_request(session, req):
-    """Delete a single request label"""
+def api_delete_request(session, req, strict=True):
+    """Delete a single request label; on failure exits, or returns None if not strict"""
 
     headers = {'Accept':'application/json'}
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/requests/delete/{}?session={}".format(req, session)
-    r = requests.get(url, headers = headers)
+    url = "{}/requests/delete/{}?session={}".format(api_url, req, session)
+    r = client.get(url, headers = headers)
 
     reply = r.json()
+    if cache:
+        cache.invalidate("requests")
     if reply['header']['userMessage'] == "OK":
         print("Deletion request for {} successful".format(req))
         return reply
     else:
         print("Deletion request for {} failed".format(req))
+        if not strict:
+            return None
         print("sys.exit(1)")
         sys.exit(1)
 
@@ -206,6 +511,7 @@ def delete_request_ticket(session, req, ticket):
     pass
 
 
+@timed("request")
 def api_make_request(session, id_type, stable_id, req_label, key="ega"):
     """Request dataset or file by stable ID"""
 
@@ -224,10 +530,12 @@ def api_make_request(session, id_type, stable_id, req_label, key="ega"):
     headers = {'Accept':'application/json'}
     form = {'rekey':key, 'downloadType': 'STREAM', 'descriptor': req_label}
     data = 'downloadrequest={{"rekey":{},"downloadType":"STREAM","descriptor":{}}}'.format(key, req_label)
-    url = "https://ega.ebi.ac.uk/ega/rest/access/v2/requests/new/{}/{}?session={}".format(id_type, stable_id, session)
-    r = requests.post(url, headers = headers, data = data)
+    url = "{}/requests/new/{}/{}?session={}".format(api_url, id_type, stable_id, session)
+    r = client.post(url, headers = headers, data = data)
 
     reply = json.loads(r.text)
+    if cache:
+        cache.invalidate("requests")
     if reply['header']['userMessage'] == "OK":
         print("Request for {} submitted successfully with label {}".format(stable_id, req_label))
         if(debug): print( json.dumps(reply, indent=4) )
@@ -238,7 +546,162 @@ def api_make_request(session, id_type, stable_id, req_label, key="ega"):
         sys.exit(1)
 
 
-def download_request(req_ticket):
+def is_encrypted(filename):
+    """True for files that EGA delivers encrypted with the request key"""
+    return filename.endswith('.cip') or filename.endswith('.gpg')
+
+
+def download_size(res):
+    """Bytes EGA sends for the file of a ticket listing entry, or None if not known (.gpg)"""
+    if res['fileName'].endswith('.gpg'):
+        return None
+    return int(res['fileSize']) + (CIP_IV_SIZE if res['fileName'].endswith('.cip') else 0)
+
+
+class ObjectStore:
+    """
+    Content-addressed local store of downloaded files, keyed by EGAF ID and listed MD5
+
+    Encrypted (.cip) objects are also keyed by the request key; the least recently used
+    objects are evicted beyond max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=STORE_MAX_BYTES, key="", link="hardlink"):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.key_id = hashlib.sha256(key.encode()).hexdigest()[:16]
+        self.link = link
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self.evict()
+
+    def path(self, res):
+        """Store path for the file of a ticket listing entry, or None if the listing has no usable MD5"""
+        if not is_md5(res.get('fileMD5')):
+            return None
+        name = res['fileMD5'].lower()
+        if is_encrypted(res['fileName']):
+            name += "-{}.cip".format(self.key_id)
+        return os.path.join(self.directory, res['fileID'], name)
+
+    def materialize(self, res, local_filename):
+        """Link the stored copy of res's file to local_filename; returns its size, or None if not stored"""
+        path = self.path(res)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            link_file(path, local_filename, self.link)
+            os.utime(path)      # mark as recently used
+            return os.path.getsize(path)
+        except OSError as e:
+            # e.g. evicted by another run in the meantime
+            print("Could not use stored copy of {}: {}".format(res['fileName'], e))
+            return None
+
+    def add(self, res, local_filename):
+        path = self.path(res)
+        if path is None or os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(local_filename, path, self.link)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for (dirpath, dirnames, filenames) in os.walk(self.directory):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for (mtime, size, path) in entries)
+            for (mtime, size, path) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if (debug): print("[store] evicting {}".format(path))
+                ListingCache.remove(path)
+                total -= size
+
+
+store = None    # ObjectStore set up by main() (--store)
+
+
+def link_file(src, dst, mode="hardlink"):
+    """
+    Make dst a copy of src, without copying any data where the file system allows
+
+    mode "hardlink" falls back to "reflink", which falls back to "copy". dst is replaced atomically.
+    """
+    tmp = "{}.{}.tmp".format(dst, uuid.uuid4().hex)
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(src, tmp)
+            except OSError:
+                mode = "reflink"
+        if mode == "reflink" and not reflink(src, tmp):
+            mode = "copy"
+        if mode == "copy":
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Renaming onto another link of the same file is a no-op that leaves tmp behind
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def reflink(src, dst):
+    """Clone src to dst sharing its data blocks (btrfs, XFS, ...); returns False if not supported"""
+    try:
+        with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def unique_files(results):
+    """Ticket listing entries with repeats of a fileID (e.g. from overlapping datasets) dropped"""
+    seen = set()
+    unique = []
+    for res in results:
+        if res['fileID'] in seen:
+            print("Skipping {} ({}), already listed under another ticket".format(res['fileName'], res['fileID']))
+            continue
+        seen.add(res['fileID'])
+        unique.append(res)
+    return unique
+
+
+def local_paths(results, output_dir="."):
+    """
+    Local path of the file for every ticket of a listing, as a dict by ticket
+
+    Files go in output_dir, or in a fileID subdirectory when their basenames clash.
+    """
+    counts = collections.Counter(os.path.split(res['fileName'])[1] for res in results)
+    paths = {}
+    for res in results:
+        name = os.path.split(res['fileName'])[1]
+        if counts[name] > 1:
+            paths[res['ticket']] = os.path.normpath(os.path.join(output_dir, res['fileID'], name))
+        else:
+            paths[res['ticket']] = os.path.normpath(os.path.join(output_dir, name))
+    return paths
+
+
+def download_request(req_ticket, chunk_size=DOWNLOAD_CHUNK_SIZE, jobs=1, retries=DOWNLOAD_RETRIES, segments=1,
+                     journal=None, verification=None, verify=False, order="api", adaptive=False, output_dir="."):
+    """
+    Download every file in a request ticket listing using up to `jobs` concurrent downloads
+
+    Returns the number of files that could not be downloaded.
+    """
     
     if req_ticket['header']['userMessage'] != "OK":
         print("download_request(): request ticket status Not ok")
@@ -247,33 +710,1206 @@ def download_request(req_ticket):
     nresults = req_ticket['response']['numTotalResults']
     print("Number of results: {}".format(nresults))
 
-    for res in req_ticket['response']['result']:
-        remote_filename = res['fileName']
-        remote_filesize = res['fileSize']
+    results = order_tickets(unique_files(req_ticket['response']['result']), order)
+    paths = local_paths(results, output_dir)
+    start = time.time()
+    outcomes = run_transfers(results, lambda res: download_result(res, chunk_size, retries, segments, journal,
+                                                                  verification, verify, start, paths[res['ticket']]),
+                             jobs, adaptive)
+
+    return print_download_summary(results, outcomes, time.time() - start)
+
+
+def download_result(res, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES, segments=1, journal=None,
+                    verification=None, verify=False, queued_since=None, local_filename=None):
+    """
+    Download the file for a single entry of a request ticket listing, retrying on failure
+
+    Linked from the ObjectStore instead if it holds a copy.
+    Returns a tuple of (bytes downloaded, error message or None)
+    """
+    remote_filename = res['fileName']
+    remote_filesize = res['fileSize']
+    local_filename = local_filename or os.path.split(remote_filename)[1]
+
+    if journal and journal.is_done(res['ticket']) and os.path.exists(local_filename):
+        print("Skipping {} ({} bytes), already downloaded".format(remote_filename, remote_filesize))
+        return (0, None)
+    if os.path.dirname(local_filename):
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+
+    start = time.time()
+    queued = start - queued_since if queued_since else 0.0
+    if link_from_store(res, local_filename, verification, queued):
+        return (0, None)
+
+    delay = RETRY_BACKOFF
+    for attempt in range(1, retries + 2):
         print("Downloading {} ({} bytes)".format(remote_filename, remote_filesize))
-        local_filename = os.path.split(remote_filename)[1]
+        try:
+            md5 = DownloadHash() if verification is not None or store else None
+            nbytes = api_download_ticket(res['ticket'], local_filename, chunk_size, download_size(res), segments,
+                                         journal, md5, needs_md5(local_filename, verify))
+            check_download(res, local_filename, md5, verification, verify, journal)
+            telemetry.record("download", time.time() - start, nbytes, attempt - 1, queued, fileID=res['fileID'])
+            return (nbytes, None)
+        except (requests.RequestException, OSError) as e:
+            error = str(e)
+            print("Download of {} failed (attempt {} of {}): {}".format(remote_filename, attempt, retries + 1, e))
+        if attempt <= retries:
+            time.sleep(delay)
+            delay *= 2
+
+    telemetry.record("download", time.time() - start, 0, retries, queued, error, fileID=res['fileID'])
+    return (0, error)
+
+
+def link_from_store(res, local_filename, verification=None, queued=0.0):
+    """
+    Materialize res's file as local_filename from the ObjectStore, if it holds a copy
 
-        dl_ticket = res['ticket']
-        api_download_ticket(dl_ticket, local_filename)
+    Recorded as a "store" telemetry event. Returns True if the file was linked.
+    """
+    start = time.time()
+    nbytes = store.materialize(res, local_filename) if store else None
+    if nbytes is None:
+        return False
+    print("Linked {} ({} bytes) from the local store".format(res['fileName'], nbytes))
+    if verification is not None:
+        # Only copies that matched their listing are stored
+        plaintext = not is_encrypted(local_filename)
+        verification[res['fileID']] = verification_record(res, nbytes, res['fileMD5'].lower() if plaintext else None,
+                                                          plaintext)
+    telemetry.record("store", time.time() - start, nbytes, queued=queued, fileID=res['fileID'])
+    return True
+
+
+def check_download(res, local_filename, md5, verification=None, verify=False, journal=None):
+    """Check a download hashed into md5 (or None) against its listing; with verify=True a mismatch raises IOError"""
+    if md5 is None:
+        return
+    nbytes = os.path.getsize(local_filename)
+    # Only the size is checked if the file was not hashed whole (see needs_md5)
+    record = verification_record(res, nbytes, md5.hexdigest() if md5.nbytes == nbytes else None,
+                                 not is_encrypted(local_filename))
+    if verification is not None:
+        verification[res['fileID']] = record
+    if not record['ok'] and verify:
+        if journal:
+            journal.forget(res['ticket'])
+        raise IOError("{} does not match the listed size/MD5".format(local_filename))
+    if store and record['ok'] and (record['sizeMatch'] or record['md5Match']):
+        try:
+            store.add(res, local_filename)
+        except OSError as e:
+            print("Could not add {} to the local store: {}".format(local_filename, e))
+
+
+def is_md5(value):
+    return isinstance(value, str) and len(value) == 32 and all(c in '0123456789abcdef' for c in value.lower())
+
+
+def needs_md5(local_filename, verify=False):
+    """Whether a download must be read back to hash it when its bytes did not arrive in order"""
+    return not is_encrypted(local_filename) and (verify or store is not None)
+
+
+class DownloadHash:
+    """MD5 of a download, with the number of bytes fed to it so that a partial hash can be told apart"""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.nbytes += len(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def verification_record(res, nbytes, md5, plaintext):
+    """
+    Compare a transferred file with the fileSize and fileMD5 of its ticket listing
 
+    Both describe the unencrypted file; an encrypted .cip download is only compared by
+    size (plus its IV). .gpg sizes and placeholder MD5s such as "TODO: MD5" are never compared.
+    """
+    expected_size = int(res['fileSize']) if plaintext else download_size(res)
+    if res['fileName'].endswith('.gpg'):
+        expected_size = None
+    size_match = nbytes == expected_size if expected_size is not None else None
+    md5_match = md5 == res['fileMD5'].lower() if md5 and plaintext and is_md5(res.get('fileMD5')) else None
+    if size_match is False or md5_match is False:
+        print("WARNING: {} does not match its listing ({} bytes, MD5 {}; expected {} bytes, MD5 {})".format(
+            res['fileName'], nbytes, md5, res['fileSize'], res.get('fileMD5')))
+
+    return {'fileName': res['fileName'], 'bytes': nbytes, 'md5': md5,
+            'expectedBytes': expected_size, 'expectedMD5': res.get('fileMD5'),
+            'sizeMatch': size_match, 'md5Match': md5_match,
+            'ok': size_match is not False and md5_match is not False}
+
+
+def check_sync_output(res, nbytes, md5, verification, verify=False):
+    """Record the verification of a decrypted file before its upload completes; with verify=True a mismatch aborts it"""
+    record = verification_record(res, nbytes, md5, True)
+    verification[res['fileID']] = record
+    if verify and not record['ok']:
+        raise IOError("{} does not match the listed size/MD5, upload aborted".format(res['fileName']))
+
+
+class VerifyingReader:
+    """Read-only wrapper for a file being uploaded that hashes it on the way and calls on_eof(nbytes, md5) at the end"""
+
+    def __init__(self, fileobj, on_eof):
+        self.fileobj = fileobj
+        self.on_eof = on_eof
+        self.md5 = hashlib.md5()
+        self.nbytes = 0
+        self.done = False
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        self.nbytes += len(data)
+        if not self.done and (size is None or size < 0 or len(data) < size):
+            self.done = True
+            self.on_eof(self.nbytes, self.md5.hexdigest())
+        return data
+
+
+def save_verification(filepath, verification):
+    """Merge verification records (by fileID) into a JSON file kept next to the request ticket copy"""
+    records = {}
+    if os.path.exists(filepath):
+        with open(filepath) as f:
+            records = json.load(f)
+    records.update(verification)
+    with open(filepath, "w+") as fo:
+        print("Writing verification results to {}".format(filepath))
+        fo.write( json.dumps(records, indent=4) )
+
+
+def print_download_summary(results, outcomes, elapsed, verb="Downloaded"):
+    """Print aggregate throughput and any failed files; returns the number of failures"""
+    total_bytes = sum(nbytes for (nbytes, error) in outcomes)
+    failures = [(res['fileName'], error) for (res, (nbytes, error)) in zip(results, outcomes) if error]
+
+    print("\n{} {} of {} files, {} bytes in {:.1f}s ({})".format(
+        verb, len(outcomes) - len(failures), len(outcomes), total_bytes, elapsed, format_rate(total_bytes, elapsed)))
+    for (remote_filename, error) in failures:
+        print("  FAILED {}: {}".format(remote_filename, error))
+
+    return len(failures)
+
+
+def format_rate(nbytes, seconds):
+    """Human readable transfer rate for nbytes moved in seconds"""
+    rate = nbytes / max(seconds, 1e-6)
+    for unit in ['B/s', 'KB/s', 'MB/s']:
+        if rate < 1024:
+            return "{:.1f} {}".format(rate, unit)
+        rate /= 1024
+    return "{:.1f} GB/s".format(rate)
+
+
+class TransferProgress:
+    """Thread-safe byte counter for one file that periodically prints its throughput"""
+
+    def __init__(self, label):
+        self.label = label
+        self.nbytes = 0
+        self.start = self.last_report = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, nbytes):
+        with self.lock:
+            self.nbytes += nbytes
+            now = time.time()
+            if now - self.last_report >= PROGRESS_INTERVAL:
+                print("  {}: {} bytes ({})".format(self.label, self.nbytes, format_rate(self.nbytes, now - self.start)))
+                self.last_report = now
+
+    def finish(self):
+        elapsed = time.time() - self.start
+        print("  {}: {} bytes in {:.1f}s ({})".format(self.label, self.nbytes, elapsed,
+                                                      format_rate(self.nbytes, elapsed)))
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing on average `rate` bytes/second, in bursts of up to one second's worth"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Take nbytes from the bucket, sleeping until they have been earned"""
+        wait = self.reserve(nbytes)
+        if wait:
+            time.sleep(wait)
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket; returns the seconds to wait before using them"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going into debt queues concurrent callers behind each other at the bucket's rate
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class ThrottledReader:
+    """Read-only wrapper for a file being uploaded that paces its reads through a list of RateLimiters"""
+
+    def __init__(self, fileobj, limiters):
+        self.fileobj = fileobj
+        self.limiters = limiters
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for limiter in self.limiters:
+            limiter.consume(len(data))
+        return data
+
+
+class Bandwidth:
+    """
+    Bandwidth shared by every transfer stream of a run
 
-def api_download_ticket(ticket, local_filename):
-    """Download an individual file, encrypted, with a download ticket UUID"""
+    max_rate caps all downloads together (and, separately, all uploads), connection_rate
+    each stream; 0 means unlimited. Bytes received are counted for AdaptiveConcurrency.
+    """
+
+    def __init__(self, max_rate=0, connection_rate=0):
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+        self.upload_limiter = RateLimiter(max_rate) if max_rate else None
+        self.connection_rate = connection_rate
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def chunks(self, response, chunk_size):
+        """response.iter_content(chunk_size), throttled to the caps"""
+        connection = RateLimiter(self.connection_rate) if self.connection_rate else None
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            with self.lock:
+                self.nbytes += len(chunk)
+            if connection:
+                connection.consume(len(chunk))
+            if self.limiter:
+                self.limiter.consume(len(chunk))
+            yield chunk
+
+    def reader(self, fileobj):
+        """fileobj, opened to be uploaded, with its reads throttled to the caps"""
+        limiters = [self.upload_limiter] if self.upload_limiter else []
+        if self.connection_rate:
+            limiters.append(RateLimiter(self.connection_rate))
+        return ThrottledReader(fileobj, limiters) if limiters else fileobj
+
+    async def async_chunks(self, response, chunk_size):
+        """An aiohttp response body in pieces of up to chunk_size, throttled to the caps without blocking the loop"""
+        connection = RateLimiter(self.connection_rate) if self.connection_rate else None
+        async for chunk in response.content.iter_chunked(chunk_size):
+            with self.lock:
+                self.nbytes += len(chunk)
+            wait = max(connection.reserve(len(chunk)) if connection else 0,
+                       self.limiter.reserve(len(chunk)) if self.limiter else 0)
+            if wait:
+                await asyncio.sleep(wait)
+            yield chunk
+
+
+bandwidth = Bandwidth()     # caps set by main() from --max-rate / --max-connection-rate
+
+
+class AdaptiveConcurrency:
+    """
+    Limit on concurrent file transfers that follows measured throughput
 
-    url = "http://ega.ebi.ac.uk/ega/rest/ds/v2/downloads/{}".format(ticket)
+    Starts at one transfer and adds one every `interval` seconds while that raises
+    throughput by 10%, up to maximum; slots are granted in transfer order.
+    """
+
+    def __init__(self, meter, maximum, interval=ADAPT_INTERVAL):
+        self.meter = meter
+        self.maximum = maximum
+        self.limit = 1
+        self.active = 0
+        self.next_position = 0
+        self.best = 0.0
+        self.grew = False
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        threading.Thread(target=self._adapt, args=(interval,), daemon=True).start()
+
+    def acquire(self, position):
+        """Wait for a free slot; slots are granted in order of position (0, 1, 2, ...)"""
+        with self.cond:
+            while self.active >= self.limit or position != self.next_position:
+                self.cond.wait()
+            self.active += 1
+            self.next_position += 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def close(self):
+        self.stopped.set()
+
+    def _adapt(self, interval):
+        last = self.meter.nbytes
+        while not self.stopped.wait(interval):
+            nbytes = self.meter.nbytes
+            rate = (nbytes - last) / interval
+            last = nbytes
+            with self.cond:
+                if self.active < self.limit:
+                    continue    # too few files left to fill the current limit, so nothing to learn
+                limit = self.limit
+                if rate > self.best * 1.1:
+                    self.best = rate
+                    if self.limit < self.maximum:
+                        self.limit += 1
+                        self.grew = True
+                elif self.grew:
+                    # The last transfer added did not pay off
+                    self.limit -= 1
+                    self.grew = False
+                elif rate < self.best * 0.7 and self.limit > 1:
+                    self.limit -= 1
+                    self.best = rate
+                if self.limit != limit:
+                    print("Concurrent transfers {} -> {} at {}".format(limit, self.limit, format_rate(rate, 1)))
+                    self.cond.notify_all()
+
+
+def order_tickets(results, order="api"):
+    """Ticket listing entries in transfer order: as listed ("api"), "largest" first or "smallest" first"""
+    if order == "api":
+        return list(results)
+    return sorted(results, key=lambda res: int(res['fileSize']), reverse=(order == "largest"))
+
+
+def run_transfers(items, fn, jobs=1, adaptive=False):
+    """Call fn(item) for every item, up to jobs at once (or adaptively); returns the results in order"""
+    jobs = max(jobs, 1)
+    if not adaptive:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(fn, items))
+
+    limit = AdaptiveConcurrency(bandwidth, jobs)
+
+    def limited(position, item):
+        limit.acquire(position)
+        try:
+            return fn(item)
+        finally:
+            limit.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(limited, range(len(items)), items))
+    finally:
+        limit.close()
+
+
+def download_url(ticket):
+    return "{}/downloads/{}".format(download_api_url, ticket)
+
+
+def api_download_ticket(ticket, local_filename, chunk_size=DOWNLOAD_CHUNK_SIZE, expected_size=None, segments=1,
+                        journal=None, hasher=None, read_back=True):
+    """
+    Download an individual file, encrypted, with a download ticket UUID
+
+    Streamed to disk in chunk_size pieces, as `segments` byte ranges where supported;
+    progress is kept in the TransferJournal and partial files are continued.
+    hasher is fed the bytes as they arrive, or (with read_back) the file once complete
+    if they did not arrive in order. Returns the number of bytes written.
+    """
+
+    url = download_url(ticket)
     if (debug): print("Requesting {}".format(url))
 
-    with open(local_filename, 'wb+') as fo:
-        headers = {'Accept': 'application/octet-stream'}
-        r = requests.get(url, headers=headers)
-        fo.write(r.content)
+    headers = {'Accept': 'application/octet-stream'}
+    progress = TransferProgress(local_filename)
+
+    ranges = journal.ranges(ticket) if journal else None
+    if ranges and os.path.exists(local_filename):
+        if probe_range_support(url, headers, expected_size) is None:
+            print("  {}: byte ranges not supported, restarting from the beginning".format(local_filename))
+            ranges = None
+        else:
+            done = sum(pos - start for (start, end, pos) in ranges)
+            print("  {}: resuming with {} bytes already on disk".format(local_filename, done))
+    else:
+        ranges = None
+
+    if ranges:
+        fd = os.open(local_filename, os.O_RDWR)
+    else:
+        total_size = probe_range_support(url, headers, expected_size) if segments > 1 else None
+        if total_size:
+            ranges = [[start, end, start] for (start, end) in split_ranges(total_size, segments)]
+            if (debug): print("{}: {} byte ranges {}".format(local_filename, len(ranges), ranges))
+        else:
+            if segments > 1:
+                print("  {}: byte ranges not supported, using a single stream".format(local_filename))
+            ranges = [[0, None, 0]]     # whole file, size not known up front
+
+        # Never truncate an existing file in place: it may be a hard link into the object store
+        if os.path.lexists(local_filename):
+            os.remove(local_filename)
+        # Preallocate (sparse) so that byte ranges can be written in place in any order
+        fd = os.open(local_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        if total_size:
+            os.ftruncate(fd, total_size)
+        if journal:
+            journal.start(ticket, local_filename, ranges)
+
+    inline_hasher = hasher if ranges == [[0, None, 0]] else None
+    try:
+        fetch_ranges(url, headers, fd, ranges, chunk_size, progress, journal, ticket, inline_hasher)
+    finally:
+        os.close(fd)
+        if journal:
+            journal.flush()
+
+    if hasher and not inline_hasher and read_back:
+        hash_file(local_filename, hasher, chunk_size)
+    if journal:
+        journal.complete(ticket)
+    progress.finish()
+    return progress.nbytes
+
+
+def hash_file(filename, hasher, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+
+
+def probe_range_support(url, headers, expected_size=None):
+    """Total size of the file at url if the server honours Range requests (else None)"""
+    r = client.get(url, headers=dict(headers, Range='bytes=0-0'), stream=True)
+    r.close()
+    if r.status_code != 206:
+        return None
+
+    # Content-Range: bytes 0-0/<total>
+    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+    if total.isdigit():
+        return int(total)
+    return expected_size
+
+
+def split_ranges(total_size, segments):
+    """Split [0, total_size) into up to `segments` contiguous (start, end) byte ranges"""
+    segments = max(1, min(segments, total_size // MIN_SEGMENT_SIZE))
+    bounds = [total_size * i // segments for i in range(segments + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fetch_ranges(url, headers, fd, ranges, chunk_size, progress, journal=None, ticket=None, hasher=None):
+    """
+    Fetch the unfinished [start, end, pos] byte ranges of url concurrently, writing them in place into fd
+
+    hasher is only fed when there is a single range, so that bytes arrive in order.
+    """
+    pending = [(i, byte_range) for (i, byte_range) in enumerate(ranges)
+               if byte_range[1] is None or byte_range[2] < byte_range[1]]
+
+    def fetch(i, byte_range):
+        on_write = (lambda pos: journal.advance(ticket, i, pos)) if journal else None
+        download_range(url, headers, fd, byte_range, chunk_size, progress, on_write,
+                       hasher if len(pending) == 1 else None)
+
+    if len(pending) == 1:
+        fetch(*pending[0])
+    elif pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            futures = [pool.submit(fetch, i, byte_range) for (i, byte_range) in pending]
+            for future in futures:
+                future.result()
+
+
+def download_range(url, headers, fd, byte_range, chunk_size, progress, on_write=None, hasher=None):
+    """Fetch the bytes [pos, end) of a [start, end, pos] range of url into the same offsets of fd (end None: to EOF)"""
+    (start, end, pos) = byte_range
+    if pos == 0 and end is None:
+        range_headers = headers
+    else:
+        range_headers = dict(headers, Range='bytes={}-{}'.format(pos, end - 1 if end is not None else ''))
+    r = client.get(url, headers=range_headers, stream=True)
+    r.raise_for_status()
+    if range_headers is not headers and r.status_code != 206:
+        raise IOError("Server ignored Range request for bytes {}-{}".format(pos, end))
+    if end is None and 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+        end = pos + int(r.headers['Content-Length'])
+
+    for chunk in bandwidth.chunks(r, chunk_size):
+        os.pwrite(fd, chunk, pos)
+        if hasher:
+            hasher.update(chunk)
+        pos += len(chunk)
+        progress.update(len(chunk))
+        if on_write:
+            on_write(pos)
+
+    if end is not None and pos != end:
+        raise IOError("Byte range {}-{} ended early at {}".format(start, end - 1, pos))
+
+
+class TransferJournal:
+    """
+    Persistent record of how far each download ticket of a request has got, for "resume"
+
+    Each ticket maps to its local file, a status ("partial" or "done") and [start, end, pos] byte ranges.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.last_flush = 0
+        self.tickets = {}
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                self.tickets = json.load(f)['tickets']
+
+    def ranges(self, ticket):
+        """Byte ranges of a partially downloaded ticket, or None"""
+        with self.lock:
+            entry = self.tickets.get(ticket)
+            if entry and entry['status'] == 'partial':
+                return [list(byte_range) for byte_range in entry['ranges']]
+        return None
+
+    def is_done(self, ticket):
+        with self.lock:
+            return ticket in self.tickets and self.tickets[ticket]['status'] == 'done'
+
+    def start(self, ticket, local_filename, ranges):
+        with self.lock:
+            self.tickets[ticket] = {'localFile': local_filename, 'status': 'partial',
+                                    'ranges': [list(byte_range) for byte_range in ranges]}
+            self._flush()
+
+    def advance(self, ticket, index, pos):
+        with self.lock:
+            self.tickets[ticket]['ranges'][index][2] = pos
+            if time.time() - self.last_flush >= JOURNAL_INTERVAL:
+                self._flush()
+
+    def forget(self, ticket):
+        """Drop a ticket, so that it is downloaded again from scratch"""
+        with self.lock:
+            self.tickets.pop(ticket, None)
+            self._flush()
+
+    def complete(self, ticket):
+        with self.lock:
+            self.tickets[ticket]['status'] = 'done'
+            self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        atomic_write(self.filepath, json.dumps({'tickets': self.tickets}))
+        self.last_flush = time.time()
+
+
+class CipDecryptor:
+    """
+    Streaming decryptor for files re-encrypted by EGA with the request key (.cip)
+
+    Same scheme as EgaDemoClient.jar: AES-256 in CTR mode, with the key derived
+    from the request key by PBKDF2-HMAC-SHA1 and the IV in the first 16 bytes.
+    """
+
+    SALT = bytes([244, 34, 1, 0, 158, 223, 78, 21])
+    ITERATIONS = 1024
+
+    def __init__(self, key):
+        if Cipher is None:
+            raise RuntimeError("In-process decryption requires the 'cryptography' module")
+        self.key = hashlib.pbkdf2_hmac('sha1', key.encode(), self.SALT, self.ITERATIONS, 32)
+        self.header = b''
+        self.cipher = None
+
+    def update(self, data):
+        if self.cipher is None:
+            self.header += data
+            if len(self.header) < CIP_IV_SIZE:
+                return b''
+            (iv, data) = (self.header[:CIP_IV_SIZE], self.header[CIP_IV_SIZE:])
+            self.cipher = Cipher(algorithms.AES(self.key), modes.CTR(iv), backend=default_backend()).decryptor()
+        return self.cipher.update(data)
+
+    def finalize(self):
+        if self.cipher is None:
+            raise IOError("Encrypted stream ended before its 16 byte IV")
+        return self.cipher.finalize()
 
 
-def sync_request(req_ticket, destination, username, password, decryption_key):
+
+def decrypted_filename(filename):
+    """Name of the decrypted copy of a .cip/.gpg file"""
+    return filename.replace('.cip', '').replace('.gpg', '')
+
+
+class DecryptStats:
+    """Thread-safe totals of bytes decrypted and seconds spent decrypting, reported apart from download time"""
+
+    def __init__(self):
+        self.files = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, files, nbytes, seconds):
+        with self.lock:
+            self.files += files
+            self.nbytes += nbytes
+            self.seconds += seconds
+
+    def report(self, label="Decrypted"):
+        if self.files:
+            print("{} {} files, {} bytes in {:.1f}s of decryption ({})".format(
+                label, self.files, self.nbytes, self.seconds, format_rate(self.nbytes, self.seconds)))
+
+
+class JarDecryptor:
+    """
+    Decrypts local .cip/.gpg files with EgaDemoClient.jar
+
+    With batch_size > 1, concurrent decrypt() calls are handed to one JVM together.
+    """
+
+    def __init__(self, username, password, decryption_key, batch_size=1, stats=None):
+        self.username = username
+        self.password = password
+        self.decryption_key = decryption_key
+        self.batch_size = batch_size
+        self.stats = stats or DecryptStats()
+        self.queue = queue.Queue()
+        if batch_size > 1:
+            threading.Thread(target=self._batches, daemon=True).start()
+
+    def decrypt(self, filename):
+        """Decrypt filename to decrypted_filename(filename); raises IOError on failure"""
+        if self.batch_size <= 1:
+            self._run([filename])
+            return
+        slot = {'filename': filename, 'done': threading.Event(), 'error': None}
+        self.queue.put(slot)
+        slot['done'].wait()
+        if slot['error']:
+            raise IOError(slot['error'])
+
+    def _batches(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + JAR_BATCH_WAIT
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._run([slot['filename'] for slot in batch])
+            except Exception as e:
+                for slot in batch:
+                    slot['error'] = str(e)
+            for slot in batch:
+                slot['done'].set()
+
+    def _run(self, filenames):
+        cmd = ['java', '-jar', EGA_CLIENT_JAR, '-p', self.username, self.password, '-dc'] + filenames + \
+              ['-dck', self.decryption_key]
+        print("Decrypting {} with {}".format(" ".join(filenames), EGA_CLIENT_JAR))
+        start = time.time()
+        tail = collections.deque(maxlen=5)
+        try:
+            p = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.STDOUT, universal_newlines=True)
+        except OSError as e:
+            raise IOError("could not run java: {}".format(e))
+        for line in p.stdout:
+            line = line.rstrip()
+            if (debug): print("[EgaDemoClient] {}".format(line))
+            if line:
+                tail.append(line)
+        p.wait()
+
+        if p.returncode != 0:
+            raise IOError("EgaDemoClient.jar exited with status {}: {}".format(p.returncode, " / ".join(tail)))
+        missing = [f for f in filenames if not os.path.exists(decrypted_filename(f))]
+        if missing:
+            raise IOError("EgaDemoClient.jar did not write {}: {}".format(
+                ", ".join(decrypted_filename(f) for f in missing), " / ".join(tail)))
+        self.stats.add(len(filenames), sum(os.path.getsize(decrypted_filename(f)) for f in filenames),
+                       time.time() - start)
+
+
+class LocalDecryptor:
+    """
+    Decrypts local .cip files in-process with CipDecryptor, streaming in chunk_size pieces
+
+    Other formats (.gpg) are handed to the fallback decryptor, e.g. a JarDecryptor.
+    """
+
+    def __init__(self, decryption_key, fallback=None, chunk_size=DOWNLOAD_CHUNK_SIZE, stats=None):
+        self.decryption_key = decryption_key
+        self.fallback = fallback
+        self.chunk_size = chunk_size
+        self.stats = stats or DecryptStats()
+
+    def decrypt(self, filename):
+        """Decrypt filename to decrypted_filename(filename); raises IOError on failure"""
+        if not filename.endswith('.cip'):
+            if self.fallback is None:
+                raise IOError("no decryptor for {}".format(filename))
+            return self.fallback.decrypt(filename)
+
+        start = time.time()
+        nbytes = 0
+        decryptor = CipDecryptor(self.decryption_key)
+        with open(filename, 'rb') as f, open(decrypted_filename(filename), 'wb') as fo:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                data = decryptor.update(chunk)
+                fo.write(data)
+                nbytes += len(data)
+            data = decryptor.finalize()
+            fo.write(data)
+            nbytes += len(data)
+        self.stats.add(1, nbytes, time.time() - start)
+
+
+def make_decryptor(backend, username, password, decryption_key, batch_size=1, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                   stats=None):
+    """Decryptor for sync's decrypt stage: "jar", "python" (in-process .cip, else jar) or "auto" (python if possible)"""
+    if backend == "auto":
+        backend = "jar" if Cipher is None else "python"
+    if backend == "python" and Cipher is None:
+        print("--decryptor python requires the 'cryptography' module (pip3 install cryptography)")
+        sys.exit(1)
+
+    stats = stats or DecryptStats()
+    jar = JarDecryptor(username, password, decryption_key, batch_size, stats)
+    if backend == "jar":
+        return jar
+    return LocalDecryptor(decryption_key, jar, chunk_size, stats)
+
+
+class StreamPipe:
+    """Bounded in-memory pipe from a producer thread to a file-like reader (e.g. boto3's upload_fileobj)"""
+
+    def __init__(self, maxchunks=STREAM_BUFFER_CHUNKS):
+        self.queue = queue.Queue(maxsize=maxchunks)
+        self.buffer = bytearray()
+        self.eof = False
+        self.abandoned = False
+
+    def write(self, data):
+        if data:
+            self._put(data)
+
+    def close(self, error=None):
+        """Signal end of stream, or pass an exception on to the reader"""
+        self._put(error)
+
+    def abandon(self):
+        """Called by the reader when it stops reading, so that a blocked producer gives up"""
+        self.abandoned = True
+
+    def _put(self, item):
+        while True:
+            if self.abandoned:
+                raise IOError("Stream reader went away")
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self.buffer += item
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def can_stream(res):
+    """True if the file of a ticket can be synced with --stream: unencrypted, or .cip (decrypted in-process)"""
+    return not is_encrypted(res['fileName']) or res['fileName'].endswith('.cip')
+
+
+def stream_sync_file(res, bucket, full_s3_key, decryption_key, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                     part_size=STREAM_PART_SIZE, verification=None, verify=False, decrypt_stats=None):
+    """
+    Sync a single ticket to S3 without touching local disk
+
+    Download, decryption and multipart upload run concurrently; returns the number of bytes downloaded.
+    """
+    local_filename = os.path.split(res['fileName'])[1]
+    if not can_stream(res):
+        raise IOError("{} cannot be decrypted in-process".format(local_filename))
+    decryptor = CipDecryptor(decryption_key) if is_encrypted(local_filename) else None
+    progress = TransferProgress(local_filename)
+    pipe = StreamPipe()
+    md5 = hashlib.md5()
+
+    def produce():
+        nbytes = 0
+        decrypt_seconds = 0.0
+        try:
+            r = client.get(download_url(res['ticket']), headers={'Accept': 'application/octet-stream'}, stream=True)
+            r.raise_for_status()
+            expected = None
+            if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                expected = int(r.headers['Content-Length'])
+            for chunk in bandwidth.chunks(r, chunk_size):
+                progress.update(len(chunk))
+                if decryptor:
+                    start = time.time()
+                    chunk = decryptor.update(chunk)
+                    decrypt_seconds += time.time() - start
+                md5.update(chunk)
+                nbytes += len(chunk)
+                pipe.write(chunk)
+            # A dropped connection can end the body early without an error (urllib3 1.x)
+            if expected is not None and progress.nbytes != expected:
+                raise IOError("Download ended early at {} of {} bytes".format(progress.nbytes, expected))
+            if decryptor:
+                chunk = decryptor.finalize()
+                md5.update(chunk)
+                nbytes += len(chunk)
+                pipe.write(chunk)
+                if decrypt_stats is not None:
+                    decrypt_stats.add(1, nbytes, decrypt_seconds)
+                telemetry.record("decrypt", decrypt_seconds, nbytes, fileID=res['fileID'])
+            if verification is not None:
+                check_sync_output(res, nbytes, md5.hexdigest(), verification, verify)
+            pipe.close()
+        except Exception as e:
+            if not pipe.abandoned:
+                pipe.close(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                            max_concurrency=UPLOAD_CONCURRENCY)
+    # Parts read ahead are buffered in memory (default 10); keep no more than are uploaded at once.
+    # boto3's TransferConfig does not take this as an argument but passes the attribute on to s3transfer.
+    config.max_in_memory_upload_chunks = UPLOAD_CONCURRENCY
+    extra_args = {'ServerSideEncryption': "AES256"}
+    try:
+        bucket.upload_fileobj(pipe, full_s3_key, ExtraArgs=extra_args, Config=config)
+    finally:
+        pipe.abandon()
+        producer.join()
+
+    progress.finish()
+    return progress.nbytes
+
+
+def parse_size(size):
+    """Parse a byte count with an optional K/M/G/T suffix (powers of 1024), e.g. 50G"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class ScratchBudget:
+    """Bounds the local disk used by in-flight sync files; reserve() blocks until space is free"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def reserve(self, nbytes):
+        with self.cond:
+            # A file larger than the whole budget is still let through once nothing else is in flight
+            while self.limit and self.used and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+def run_pipeline(items, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Push items through a chain of stages, each served by its own pool of worker threads
+
+    stages is a list of (workers, fn), where fn(item) returns the item for the next
+    stage or None to drop it; stages are connected by queues of queue_size items.
+    """
+    queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0][0]):
+        queues[0].put(None)
+
+    running = [workers for (workers, fn) in stages]
+    lock = threading.Lock()
+
+    def work(i):
+        fn = stages[i][1]
+        while True:
+            item = queues[i].get()
+            if item is None:
+                break
+            try:
+                item = fn(item)
+            except Exception as e:
+                print("Pipeline stage {} failed: {}".format(fn.__name__, e))
+                item = None
+            if item is not None and i + 1 < len(stages):
+                queues[i + 1].put(item)
+
+        # The last worker of a stage to finish shuts down the next stage
+        with lock:
+            running[i] -= 1
+            last = running[i] == 0
+        if last and i + 1 < len(stages):
+            for _ in range(stages[i + 1][0]):
+                queues[i + 1].put(None)
+
+    threads = [threading.Thread(target=work, args=(i,), daemon=True)
+               for (i, (workers, fn)) in enumerate(stages) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def upload_config(size):
+    """TransferConfig for uploading size bytes from a reader boto3 cannot size, in at most S3_MAX_PARTS parts"""
+    part_size = max(UPLOAD_PART_SIZE, -(-size // S3_MAX_PARTS))
+    return TransferConfig(multipart_threshold=UPLOAD_PART_SIZE, multipart_chunksize=part_size)
+
+
+def sync_stage(fn):
+    """Decorator for DiskSync stages: an unexpected error fails the job, releasing its scratch space"""
+    @functools.wraps(fn)
+    def wrapper(self, job):
+        try:
+            return fn(self, job)
+        except Exception as e:
+            return self.fail(job, "{} failed: {}".format(fn.__name__, e))
+    return wrapper
+
+
+class DiskSync:
+    """
+    Download -> decrypt -> upload stages for syncing tickets through local scratch disk
+
+    Each stage takes and returns a job dict, or records the error and returns None.
+    """
+
+    def __init__(self, bucket, destination, decryptor, chunk_size=DOWNLOAD_CHUNK_SIZE, segments=1,
+                 retries=DOWNLOAD_RETRIES, budget=None, verification=None, verify=False):
+        self.bucket = bucket
+        self.destination = destination
+        self.decryptor = decryptor
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.retries = retries
+        self.budget = budget or ScratchBudget()
+        self.verification = verification
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.outcomes = {}      # ticket -> (bytes downloaded, error message or None)
+
+    def job(self, res, full_s3_key, position=0):
+        local_filename = os.path.split(res['fileName'])[1]
+        return {'res': res, 'local_filename': local_filename, 'full_s3_key': full_s3_key,
+                'unencrypted': decrypted_filename(local_filename),
+                'encrypted': is_encrypted(local_filename),
+                'reserved': 0, 'bytes': 0, 'ready': time.time(), 'position': position}
+
+    @sync_stage
+    def download(self, job):
+        size = int(job['res']['fileSize'])
+        job['reserved'] = 2 * size if job['encrypted'] else size
+        self.budget.reserve(job['reserved'])
+
+        (job['bytes'], error) = download_result(job['res'], self.chunk_size, self.retries, self.segments,
+                                                queued_since=job['ready'])
+        if error:
+            return self.fail(job, error)
+        job['ready'] = time.time()
+        return job
+
+    @sync_stage
+    def decrypt(self, job):
+        if not job['encrypted']:
+            return job
+
+        local_filename = job['local_filename']
+        start = time.time()
+        try:
+            self.decryptor.decrypt(local_filename)
+        except Exception as e:
+            self.event("decrypt", job, start, error=str(e))
+            return self.fail(job, "decryption failed: {}".format(e))
+        self.event("decrypt", job, start, os.path.getsize(job['unencrypted']))
+
+        # The encrypted copy is no longer needed once decrypted
+        self.remove(job, local_filename, job['reserved'] // 2)
+        return job
+
+    @sync_stage
+    def upload(self, job):
+        extra_args = {'ServerSideEncryption': "AES256"}
+        unencrypted = job['unencrypted']
+        print('Uploading %s to %s' % (unencrypted, os.path.join(self.destination, unencrypted)))
+        start = time.time()
+        try:
+            with open(unencrypted, 'rb') as f:
+                reader = bandwidth.reader(f)
+                if self.verification is not None:
+                    # Hash the decrypted file as the upload reads it, rather than in a separate pass
+                    check = lambda nbytes, md5: check_sync_output(job['res'], nbytes, md5, self.verification,
+                                                                  self.verify)
+                    reader = VerifyingReader(reader, check)
+                self.bucket.upload_fileobj(reader, job['full_s3_key'], ExtraArgs=extra_args,
+                                           Config=upload_config(os.path.getsize(unencrypted)))
+        except Exception as e:
+            self.event("upload", job, start, error=str(e))
+            return self.fail(job, "upload failed: {}".format(e))
+        self.event("upload", job, start, os.path.getsize(unencrypted))
+
+        self.remove(job, unencrypted, job['reserved'])
+        self.record(job, None)
+
+    def event(self, stage, job, start, nbytes=0, error=None):
+        """Record a telemetry event for a stage that started at start, and mark the job ready for the next one"""
+        now = time.time()
+        telemetry.record(stage, now - start, nbytes, queued=start - job['ready'], error=error,
+                         fileID=job['res']['fileID'])
+        job['ready'] = now
+
+    def fail(self, job, error):
+        print("Sync of {} failed: {}".format(job['res']['fileName'], error))
+        for filename in (job['local_filename'], job['unencrypted']):
+            try:
+                self.remove(job, filename, job['reserved'] if filename == job['unencrypted'] else 0)
+            except OSError as e:
+                print("Could not remove {}: {}".format(filename, e))
+        self.record(job, error)
+
+    def remove(self, job, filename, nbytes):
+        """Remove a local copy and release nbytes of the job's scratch space, even if the removal fails"""
+        try:
+            if os.path.exists(filename):
+                os.remove(filename)
+        finally:
+            job['reserved'] -= nbytes
+            self.budget.release(nbytes)
+
+    def record(self, job, error):
+        with self.lock:
+            self.outcomes[job['res']['ticket']] = (job['bytes'], error)
+
+
+def stream_sync_result(res, bucket, full_s3_key, decryption_key, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                       part_size=STREAM_PART_SIZE, verification=None, verify=False, decrypt_stats=None,
+                       queued_since=None, retries=DOWNLOAD_RETRIES):
+    """
+    stream_sync_file() for one ticket, retrying on failure, recorded as a "stream" telemetry event
+
+    Returns a tuple of (bytes downloaded, error message or None)
+    """
+    start = time.time()
+    queued = start - queued_since if queued_since else 0.0
+    delay = RETRY_BACKOFF
+    for attempt in range(1, retries + 2):
+        try:
+            nbytes = stream_sync_file(res, bucket, full_s3_key, decryption_key, chunk_size, part_size, verification,
+                                      verify, decrypt_stats)
+            telemetry.record("stream", time.time() - start, nbytes, attempt - 1, queued, fileID=res['fileID'])
+            return (nbytes, None)
+        except Exception as e:
+            error = str(e)
+            print("Sync of {} failed (attempt {} of {}): {}".format(res['fileName'], attempt, retries + 1, e))
+        if attempt <= retries:
+            time.sleep(delay)
+            delay *= 2
+
+    telemetry.record("stream", time.time() - start, 0, retries, queued, error, fileID=res['fileID'])
+    return (0, error)
+
+
+def list_s3_inventory(bucket, prefix=""):
+    """Index every object under prefix with one (paginated) listing, as a dict of key -> (size, ETag)"""
+    inventory = {}
+    for obj in bucket.objects.filter(Prefix=prefix):
+        inventory[obj.key] = (obj.size, obj.e_tag)
+    if (debug): print("Found {} objects under {}".format(len(inventory), prefix))
+    return inventory
+
+
+def expected_upload_size(res):
+    """Size in bytes the synced object for a ticket should have, or None if unknown (.gpg)"""
+    if res['fileName'].endswith('.gpg'):
+        return None
+    return int(res['fileSize'])
+
+
+def is_synced(inventory, full_s3_key, expected_size=None):
+    """True if full_s3_key is in the S3 inventory with the expected size (any non-zero size if None)"""
+    if full_s3_key not in inventory:
+        return False
+    (size, etag) = inventory[full_s3_key]
+    if expected_size is None:
+        return size > 0
+    return size == expected_size
+
+
+def sync_request(req_ticket, destination, username, password, decryption_key, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 segments=1, stream=False, part_size=STREAM_PART_SIZE, jobs=(1, 1, 1), retries=DOWNLOAD_RETRIES,
+                 scratch_budget=None, verification=None, verify=False, decryptor="jar", jar_batch=1, order="api",
+                 adaptive=False, synced=None, resend=None):
+    """
+    Download, decrypt and upload every file in a request ticket listing to an s3:// destination
+
+    Through local disk in a download -> decrypt -> upload pipeline, or with stream=True
+    piped straight into S3. Returns the number of files that could not be synced.
+    """
     if req_ticket['header']['userMessage'] != "OK":
         print("sync_request(): request ticket status Not ok")
         sys.exit(1)
 
+    if stream and Cipher is None:
+        print("sync --stream requires the 'cryptography' module (pip3 install cryptography)")
+        sys.exit(1)
+
     nresults = req_ticket['response']['numTotalResults']
     print("Number of results: {}".format(nresults))
 
@@ -281,10 +1917,13 @@ def sync_request(req_ticket, destination, username, password, decryption_key):
     s3_bucket = parse_result.netloc.lstrip('/')
     s3_key = parse_result.path
 
-    s3 = boto3.resource('s3')
+    s3 = boto3.resource('s3', endpoint_url=s3_endpoint_url)
     bucket = s3.Bucket(s3_bucket)
 
-    for res in req_ticket['response']['result']:
+    inventory = list_s3_inventory(bucket, s3_key.lstrip('/'))
+
+    pending = []
+    for res in order_tickets(unique_files(req_ticket['response']['result']), order):
         remote_filename = res['fileName']
         remote_filesize = res['fileSize']
 
@@ -293,33 +1932,598 @@ def sync_request(req_ticket, destination, username, password, decryption_key):
         if full_s3_key.startswith('/'):
             full_s3_key = full_s3_key[1:]
 
-        objs = list(bucket.objects.filter(Prefix=full_s3_key))
-        if len(objs) > 0 and objs[0].key == full_s3_key:
+        if res['fileID'] not in (resend or ()) and is_synced(inventory, full_s3_key, expected_upload_size(res)):
             print("Skipping {} ({} bytes)".format(remote_filename, remote_filesize))
-            continue
+            if synced is not None:
+                synced[res['fileID']] = full_s3_key
+        else:
+            if full_s3_key in inventory:
+                print("Re-sending {}: s3://{}/{} has unexpected size {}".format(
+                    remote_filename, s3_bucket, full_s3_key, inventory[full_s3_key][0]))
+            pending.append((res, full_s3_key))
+
+    start = time.time()
+    decrypt_stats = DecryptStats()
+    outcomes = {}   # ticket -> (bytes downloaded, error message or None)
+    on_disk = pending
+    if stream:
+        streamed = [item for item in pending if can_stream(item[0])]
+        on_disk = [item for item in pending if not can_stream(item[0])]
+        if on_disk:
+            print("{} files cannot be decrypted in-process and are synced through local disk".format(len(on_disk)))
+        results = run_transfers(streamed, lambda item: stream_sync_result(item[0], bucket, item[1], decryption_key,
+                                                                          chunk_size, part_size, verification, verify,
+                                                                          decrypt_stats, start, retries),
+                                jobs[0], adaptive)
+        outcomes.update(zip([res['ticket'] for (res, full_s3_key) in streamed], results))
+
+    if on_disk:
+        file_decryptor = make_decryptor(decryptor, username, password, decryption_key, jar_batch, chunk_size,
+                                        decrypt_stats)
+        disk_sync = DiskSync(bucket, destination, file_decryptor, chunk_size, segments, retries,
+                             ScratchBudget(scratch_budget), verification, verify)
+        if adaptive:
+            limit = AdaptiveConcurrency(bandwidth, max(jobs[0], 1))
+
+            def adaptive_download(job):
+                limit.acquire(job['position'])
+                try:
+                    return disk_sync.download(job)
+                finally:
+                    limit.release()
+        stages = [(max(jobs[0], 1), adaptive_download if adaptive else disk_sync.download),
+                  (max(jobs[1], 1), disk_sync.decrypt),
+                  (max(jobs[2], 1), disk_sync.upload)]
+        run_pipeline([disk_sync.job(res, full_s3_key, position)
+                      for (position, (res, full_s3_key)) in enumerate(on_disk)], stages)
+        if adaptive:
+            limit.close()
+        outcomes.update(disk_sync.outcomes)
+    outcomes = [outcomes.get(res['ticket'], (0, "sync did not complete")) for (res, full_s3_key) in pending]
+
+    if synced is not None:
+        for ((res, full_s3_key), (nbytes, error)) in zip(pending, outcomes):
+            if error is None:
+                synced[res['fileID']] = full_s3_key
+
+    failures = print_download_summary([res for (res, full_s3_key) in pending], outcomes, time.time() - start, "Synced")
+    decrypt_stats.report()
+    return failures
+
+
+class SyncManifest:
+    """
+    Record of what sync --incremental has delivered to a destination, as JSON in a local file or S3 object
+
+    Maps fileIDs to their listed size, MD5 and S3 key, and keeps request labels not yet deleted.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.files = {}         # fileID -> {'fileName', 'fileSize', 'fileMD5', 'key'}
+        self.labels = []        # request labels not yet deleted
+        self.listed = {}        # fileID -> dataset listing entry seen by changed() in this run
+
+    def object(self):
+        url = urlparse(self.location)
+        return boto3.resource('s3', endpoint_url=s3_endpoint_url).Object(url.netloc, url.path.lstrip('/'))
+
+    def load(self):
+        try:
+            if self.location.startswith('s3://'):
+                data = json.loads(self.object().get()['Body'].read().decode())
+            else:
+                with open(self.location) as f:
+                    data = json.load(f)
+        except FileNotFoundError:
+            return self
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            return self
+        self.files = data.get('files', {})
+        self.labels = data.get('labels', [])
+        print("Read sync manifest {} ({} files)".format(self.location, len(self.files)))
+        return self
+
+    def save(self):
+        data = json.dumps({'files': self.files, 'labels': self.labels})
+        if self.location.startswith('s3://'):
+            self.object().put(Body=data.encode(), ServerSideEncryption="AES256")
         else:
-            print("Downloading {} ({} bytes)".format(remote_filename, remote_filesize))
+            atomic_write(self.location, data)
+
+    def changed(self, listing, inventory):
+        """True if the file of a listing entry is new, changed, or missing (or truncated) in the S3 inventory"""
+        if 'fileSize' in listing:
+            self.listed[listing['fileID']] = listing
+        entry = self.files.get(listing['fileID'])
+        if entry is None:
+            return True
+        if 'fileSize' in listing and (str(listing['fileSize']) != str(entry['fileSize']) or
+                                      listing.get('fileMD5') != entry['fileMD5']):
+            return True
+        return not is_synced(inventory, entry['key'], expected_upload_size(listing if 'fileSize' in listing else entry))
+
+    def record(self, res, key):
+        """Note a synced file, with the size and MD5 of its dataset listing where one was seen"""
+        listing = self.listed.get(res['fileID'], res)
+        self.files[res['fileID']] = {'fileName': listing['fileName'], 'fileSize': listing['fileSize'],
+                                     'fileMD5': listing.get('fileMD5'), 'key': key}
+
+
+def sync_manifest_location(destination):
+    """Default location of the sync --incremental manifest: an object under the destination prefix"""
+    return destination.rstrip('/') + "/" + SYNC_MANIFEST_NAME
 
-            dl_ticket = res['ticket']
-            api_download_ticket(dl_ticket, local_filename)
 
-            if local_filename.endswith('.cip') or local_filename.endswith('.gpg'):
-                cmd = 'java -jar /usr/src/app/EgaDemoClient.jar -p %s %s -dc %s -dck %s' % (username, password,
-                                                                                            local_filename, decryption_key)
-                print(cmd)
+def request_changed_files(session, identifiers, destination, key, manifest):
+    """
+    Request only the files of identifiers that are new or changed since the last incremental sync
 
-                p = sub.Popen(cmd.split(), stdout=sub.PIPE, stderr=sub.PIPE)
-                output, errors = p.communicate()
+    Returns (label, list reply, fileIDs changed since synced), or (None, None, set()).
+    """
+    url = urlparse(destination)
+    bucket = boto3.resource('s3', endpoint_url=s3_endpoint_url).Bucket(url.netloc)
+    inventory = list_s3_inventory(bucket, url.path.lstrip('/'))
+
+    requests = []   # (id_type, stable_id)
+    changed = set()
+    for identifier in identifiers:
+        if stable_id_type(identifier) == "datasets":
+            listing = api_list_files_in_dataset(session, identifier)['response']['result']
+            file_ids = [res['fileID'] for res in listing if manifest.changed(res, inventory)]
+            print("{}: {} of {} files new or changed".format(identifier, len(file_ids), len(listing)))
+            if file_ids and len(file_ids) == len(listing):
+                requests.append(("datasets", identifier))
+            else:
+                requests += [("files", file_id) for file_id in file_ids]
+            changed.update(file_ids)
+        elif manifest.changed({'fileID': identifier}, inventory):
+            requests.append(("files", identifier))
+            changed.add(identifier)
+    requests = list(collections.OrderedDict.fromkeys(requests))
+    if not requests:
+        return (None, None, set())
+
+    req_label = str(uuid.uuid4())
+    manifest.labels.append(req_label)
+    manifest.save()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=min(len(requests), REQUEST_CONCURRENCY)) as pool:
+        list(pool.map(lambda request: api_make_request(session, request[0], request[1], req_label, key), requests))
+    print("Requested {} files in {:.1f}s".format(len(changed), time.time() - start))
+    resend = set(file_id for file_id in changed if file_id in manifest.files)
+    return (req_label, api_list_requests(session, req_label), resend)
+
+
+def delete_request_labels(session, manifest, labels):
+    """Delete request labels and drop them from the manifest (also on failure, so they are not retried forever)"""
+    for req_label in labels:
+        api_delete_request(session, req_label, strict=False)
+        manifest.labels.remove(req_label)
+    manifest.save()
+
+
+class AsyncEgaClient:
+    """
+    asyncio counterpart of EgaClient and the api_* functions, for fetch/resume --async
 
-            extra_args = {'ServerSideEncryption': "AES256"}
-            unencrypted = local_filename.replace('.cip', '').replace('.gpg', '')
-            print('Uploading %s to %s' % (unencrypted, os.path.join(destination, unencrypted)))
-            bucket.upload_file(unencrypted, full_s3_key, ExtraArgs=extra_args)
+    Use as "async with AsyncEgaClient(...) as ega:".
+    """
 
-            if os.path.exists(local_filename):
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        if aiohttp is None:
+            raise RuntimeError("--async requires the 'aiohttp' module")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, method, url, **kwargs):
+        """Response to method url, retried as described above; the caller must release() it"""
+        retries = self.retries if method == 'GET' else 0
+        for attempt in range(retries + 1):
+            try:
+                response = await self.session.request(method, url, **kwargs)
+                if response.status < 500 or attempt == retries:
+                    return response
+                response.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def json(self, stage, call, method, url, **kwargs):
+        """JSON reply to an API call, recorded as a telemetry event of the given stage"""
+        start = time.time()
+        response = await self.request(method, url, headers={'Accept': 'application/json'}, **kwargs)
+        try:
+            reply = await response.json(content_type=None)
+        finally:
+            response.release()
+        telemetry.record(stage, time.time() - start, call=call)
+        return reply
+
+    async def login(self, username, password):
+        data = 'loginrequest={{"username": "{}", "password": "{}"}}'.format(username, password)
+        reply = await self.json("login", "login", 'POST', "{}/users/login".format(api_url), data=data)
+        result = reply['response']['result']
+        if result[0] == "success":
+            print("Login success for user {}".format(username))
+            return result[1]
+        print("Login failure for user {}".format(username))
+        return ""
+
+    async def logout(self, session):
+        await self.json("logout", "logout", 'GET', "{}/users/logout?session={}".format(api_url, session))
+        print("[Logout]")
+
+    async def list_authorized_datasets(self, session):
+        reply = await self.json("listing", "list_authorized_datasets", 'GET',
+                                "{}/datasets?session={}".format(api_url, session))
+        if reply['header']['userMessage'] != "OK":
+            print("List authorized datasets failed")
+            sys.exit(1)
+        return reply
+
+    async def list_files_in_dataset(self, session, dataset):
+        reply = await self.json("listing", "list_files_in_dataset", 'GET',
+                                "{}/datasets/{}/files?session={}".format(api_url, dataset, session))
+        if reply['header']['userMessage'] != "OK":
+            print("List files in dataset {} failed".format(dataset))
+            sys.exit(1)
+        return reply
+
+    async def make_request(self, session, id_type, stable_id, req_label, key="ega"):
+        data = 'downloadrequest={{"rekey":{},"downloadType":"STREAM","descriptor":{}}}'.format(key, req_label)
+        reply = await self.json("request", "make_request", 'POST',
+                                "{}/requests/new/{}/{}?session={}".format(api_url, id_type, stable_id, session),
+                                data=data)
+        if cache:
+            cache.invalidate("requests")
+        if reply['header']['userMessage'] != "OK":
+            print("Request for {} was unsuccessful.".format(stable_id))
+            sys.exit(1)
+        print("Request for {} submitted successfully with label {}".format(stable_id, req_label))
+        return reply
+
+    async def list_requests(self, session, req=""):
+        url = "{}/requests{}?session={}".format(api_url, "/" + req if req else "", session)
+        reply = await self.json("listing", "list_requests", 'GET', url)
+        if reply['header']['userMessage'] != "OK":
+            print("list_requests({}) failed".format(req))
+            sys.exit(1)
+        print("list_requests({}) completed successfully".format(req))
+        return reply
+
+    async def delete_request(self, session, req):
+        reply = await self.json("request", "delete_request", 'GET',
+                                "{}/requests/delete/{}?session={}".format(api_url, req, session))
+        if cache:
+            cache.invalidate("requests")
+        if reply['header']['userMessage'] != "OK":
+            print("Deletion request for {} failed".format(req))
+            sys.exit(1)
+        print("Deletion request for {} successful".format(req))
+        return reply
+
+    async def download(self, ticket, local_filename, chunk_size=DOWNLOAD_CHUNK_SIZE, journal=None, hasher=None,
+                       read_back=True):
+        """
+        Stream the file of a download ticket to local_filename; returns the number of bytes written
+
+        As api_download_ticket, a partial file recorded in the TransferJournal is
+        continued with Range requests rather than downloaded again.
+        """
+        progress = TransferProgress(local_filename)
+        ranges = journal.ranges(ticket) if journal else None
+        if ranges and os.path.exists(local_filename):
+            done = sum(pos - start for (start, end, pos) in ranges)
+            print("  {}: resuming with {} bytes already on disk".format(local_filename, done))
+            fd = os.open(local_filename, os.O_RDWR)
+        else:
+            ranges = [[0, None, 0]]
+            # Never truncate an existing file in place: it may be a hard link into the object store
+            if os.path.lexists(local_filename):
                 os.remove(local_filename)
-            if os.path.exists(unencrypted):
-                os.remove(unencrypted)
+            fd = os.open(local_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            if journal:
+                journal.start(ticket, local_filename, ranges)
+
+        inline_hasher = hasher if ranges == [[0, None, 0]] else None
+        try:
+            for (i, byte_range) in enumerate(ranges):
+                if byte_range[1] is None or byte_range[2] < byte_range[1]:
+                    await self.download_range(ticket, fd, i, byte_range, chunk_size, progress, journal, inline_hasher)
+        finally:
+            os.close(fd)
+            if journal:
+                journal.flush()
+
+        if hasher and not inline_hasher and read_back:
+            await asyncio.get_event_loop().run_in_executor(None, hash_file, local_filename, hasher, chunk_size)
+        if journal:
+            journal.complete(ticket)
+        progress.finish()
+        return progress.nbytes
+
+    async def download_range(self, ticket, fd, index, byte_range, chunk_size, progress, journal=None, hasher=None):
+        """
+        Fetch the bytes [pos, end) of a [start, end, pos] range of a ticket's file into fd
+
+        Each chunk is written in the executor and awaited before more is read.
+        """
+        loop = asyncio.get_event_loop()
+        (start, end, pos) = byte_range
+        headers = {'Accept': 'application/octet-stream'}
+        if pos > 0 or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(pos, end - 1 if end is not None else '')
+        response = await self.request('GET', download_url(ticket), headers=headers)
+        try:
+            response.raise_for_status()
+            if 'Range' in headers and response.status != 206:
+                if journal:
+                    journal.forget(ticket)  # so that the next attempt starts from the beginning
+                raise IOError("Server ignored Range request for bytes {}-{}".format(pos, end))
+            if end is None and response.content_length is not None:
+                end = pos + response.content_length
+
+            def write(data, offset):
+                os.pwrite(fd, data, offset)
+                if hasher:
+                    hasher.update(data)
+
+            buffer = bytearray()
+            async for chunk in bandwidth.async_chunks(response, chunk_size):
+                buffer += chunk
+                if len(buffer) >= chunk_size:
+                    await loop.run_in_executor(None, write, bytes(buffer), pos)
+                    pos += len(buffer)
+                    progress.update(len(buffer))
+                    buffer.clear()
+                    if journal:
+                        journal.advance(ticket, index, pos)
+            if buffer:
+                await loop.run_in_executor(None, write, bytes(buffer), pos)
+                pos += len(buffer)
+                progress.update(len(buffer))
+                if journal:
+                    journal.advance(ticket, index, pos)
+        finally:
+            response.release()
+
+        if end is not None and pos != end:
+            raise IOError("Byte range {}-{} ended early at {}".format(start, end - 1, pos))
+
+
+def run_async(coroutine):
+    """Run a coroutine to completion on a new event loop (asyncio.run() needs Python 3.7)"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def async_download_request(ega, req_ticket, chunk_size=DOWNLOAD_CHUNK_SIZE, jobs=1, retries=DOWNLOAD_RETRIES,
+                                 journal=None, verification=None, verify=False, order="api", output_dir="."):
+    """download_request() on an AsyncEgaClient, with files fetched as single streams; returns the number of failures"""
+    if req_ticket['header']['userMessage'] != "OK":
+        print("download_request(): request ticket status Not ok")
+        sys.exit(1)
+    print("Number of results: {}".format(req_ticket['response']['numTotalResults']))
+
+    results = order_tickets(unique_files(req_ticket['response']['result']), order)
+    paths = local_paths(results, output_dir)
+    limit = asyncio.Semaphore(max(jobs, 1))
+    start = time.time()
+    outcomes = await asyncio.gather(*[async_download_result(ega, res, paths[res['ticket']], limit, chunk_size, retries,
+                                                            journal, verification, verify, start)
+                                      for res in results])
+
+    return print_download_summary(results, outcomes, time.time() - start)
+
+
+async def async_download_result(ega, res, local_filename, limit, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                                retries=DOWNLOAD_RETRIES, journal=None, verification=None, verify=False,
+                                queued_since=None):
+    """download_result() on an AsyncEgaClient, once a slot of the limit semaphore is free"""
+    async with limit:
+        remote_filename = res['fileName']
+        if journal and journal.is_done(res['ticket']) and os.path.exists(local_filename):
+            print("Skipping {} ({} bytes), already downloaded".format(remote_filename, res['fileSize']))
+            return (0, None)
+        if os.path.dirname(local_filename):
+            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+
+        start = time.time()
+        queued = start - queued_since if queued_since else 0.0
+        if link_from_store(res, local_filename, verification, queued):
+            return (0, None)
+
+        delay = RETRY_BACKOFF
+        for attempt in range(1, retries + 2):
+            print("Downloading {} ({} bytes)".format(remote_filename, res['fileSize']))
+            try:
+                md5 = DownloadHash() if verification is not None or store else None
+                nbytes = await ega.download(res['ticket'], local_filename, chunk_size, journal, md5,
+                                            needs_md5(local_filename, verify))
+                check_download(res, local_filename, md5, verification, verify, journal)
+                telemetry.record("download", time.time() - start, nbytes, attempt - 1, queued, fileID=res['fileID'])
+                return (nbytes, None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                error = str(e) or type(e).__name__
+                print("Download of {} failed (attempt {} of {}): {}".format(remote_filename, attempt, retries + 1,
+                                                                            error))
+            if attempt <= retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        telemetry.record("download", time.time() - start, 0, retries, queued, error, fileID=res['fileID'])
+        return (0, error)
+
+
+async def async_request_identifiers(ega, session, identifiers, key):
+    """request_identifiers() on an AsyncEgaClient, with every identifier requested at once"""
+    async def request(identifier):
+        req_label = str(uuid.uuid4())
+        await ega.make_request(session, stable_id_type(identifier), identifier, req_label, key)
+        return (req_label, await ega.list_requests(session, req_label))
+
+    start = time.time()
+    replies = await asyncio.gather(*[request(identifier) for identifier in identifiers])
+    return merge_requests(replies, start)
+
+
+async def async_download_command(args, username, password, key, identifiers=None, pool_size=HTTP_POOL_SIZE):
+    """The fetch and resume subcommands with --async; returns the number of files that failed"""
+    async with AsyncEgaClient(pool_size, (HTTP_TIMEOUT[0], args.timeout), args.http_retries) as ega:
+        session = await ega.login(username, password)
+        if not session:
+            sys.exit(1)
+        try:
+            if args.subcommand == "fetch":
+                (req_label, list_reply) = await async_request_identifiers(ega, session, identifiers, key)
+                save_ticket_copy(req_label, list_reply)
+            else:
+                req_label = args.label
+                list_reply = load_ticket_copy(req_label) or await ega.list_requests(session, req_label)
+            journal = TransferJournal(req_label + ".journal.json")
+            verification = {}
+            failures = await async_download_request(ega, list_reply, args.chunk_size, args.jobs, args.retries,
+                                                    journal, verification, args.verify, args.order, args.output_dir)
+            save_verification(req_label + ".verify.json", verification)
+        finally:
+            await ega.logout(session)
+    return failures
+
+
+def stable_id_type(identifier):
+    """The API id_type for a stable id ("datasets" for EGAD..., "files" for EGAF...), or None"""
+    if identifier[3:4] == 'D':
+        return "datasets"
+    elif identifier[3:4] == 'F':
+        return "files"
+    return None
+
+
+def read_manifest(filepath):
+    """Stable ids listed in a manifest file, one per line; blank lines and # comments are ignored"""
+    identifiers = []
+    with open(filepath) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line and line not in identifiers:
+                identifiers.append(line)
+    return identifiers
+
+
+def command_identifiers(args):
+    """Stable ids to fetch or sync, from either the identifier argument or --manifest"""
+    if bool(args.identifier) == bool(args.manifest):
+        print("Give either a stable id or --manifest, but not both")
+        sys.exit(1)
+    identifiers = read_manifest(args.manifest) if args.manifest else [args.identifier]
+
+    for identifier in identifiers:
+        if not stable_id_type(identifier):
+            print("Unrecognized identifier {} -- only datasets (EGAD...) and and files (EGAF...) supported".format(
+                identifier))
+            sys.exit(1)
+    return identifiers
+
+
+def request_identifiers(session, identifiers, key):
+    """
+    Make a download request for each identifier, all at the same time, and merge their ticket listings
+
+    Returns (label, list reply); a batch gets a new label naming the merged listing.
+    """
+    def request(identifier):
+        req_label = str(uuid.uuid4())
+        api_make_request(session, stable_id_type(identifier), identifier, req_label, key)
+        return (req_label, api_list_requests(session, req_label))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=min(len(identifiers), REQUEST_CONCURRENCY)) as pool:
+        replies = list(pool.map(request, identifiers))
+    return merge_requests(replies, start)
+
+
+def merge_requests(replies, start):
+    """Merge the (label, list reply) of each identifier of a batch requested since start (see request_identifiers)"""
+    if len(replies) == 1:
+        return replies[0]
+
+    results = []
+    tickets = set()
+    for (req_label, list_reply) in replies:
+        for res in list_reply['response']['result']:
+            if res['ticket'] not in tickets:
+                tickets.add(res['ticket'])
+                results.append(res)
+
+    print("Requested {} identifiers ({} files) in {:.1f}s".format(len(replies), len(results), time.time() - start))
+    batch_reply = {'header': {'userMessage': "OK"},
+                   'response': {'numTotalResults': len(results), 'result': results},
+                   'requestLabels': [req_label for (req_label, list_reply) in replies]}
+    return (str(uuid.uuid4()), batch_reply)
+
+
+def save_ticket_copy(req_label, list_reply):
+    """Save a copy of the request ticket listing as <label>.json"""
+    with open(req_label + ".json", "w+") as fo:
+        print("Writing copy of request ticket to {}".format(req_label + ".json"))
+        fo.write( json.dumps(list_reply) )
+
+
+def load_ticket_copy(req_label):
+    """The saved copy of a request ticket listing, or None if there is none"""
+    # Prefer the saved ticket copy: EGA stops listing tickets once they have been downloaded
+    if not os.path.exists(req_label + ".json"):
+        return None
+    print("Reading copy of request ticket from {}".format(req_label + ".json"))
+    with open(req_label + ".json") as f:
+        return json.load(f)
+
+
+def add_download_arguments(subparser):
+    """Options shared by the subcommands that download a request (fetch, resume)"""
+    subparser.add_argument("--chunk-size", type=int, default=DOWNLOAD_CHUNK_SIZE,
+                           help="Bytes buffered in memory per download stream (default {})".format(DOWNLOAD_CHUNK_SIZE))
+    subparser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to download concurrently")
+    subparser.add_argument("--retries", type=int, default=DOWNLOAD_RETRIES,
+                           help="Retries per file before it is reported as failed (default {})".format(DOWNLOAD_RETRIES))
+    subparser.add_argument("--segments", type=int, default=1,
+                           help="Download each large file as this many concurrent byte ranges")
+    subparser.add_argument("--verify", action="store_true",
+                           help="Fail files whose size or MD5 does not match the listing (always checked and recorded)")
+    subparser.add_argument("-o", "--output-dir", default=".", help="Directory to save the files in (default .)")
+    subparser.add_argument("--async", dest="use_async", action="store_true",
+                           help="Drive all downloads from one asyncio event loop (needs aiohttp); suits hundreds "
+                                "of concurrent --jobs. Files are fetched as single streams (no --segments)")
+    add_schedule_arguments(subparser)
+
+
+def add_schedule_arguments(subparser):
+    """Options shared by the subcommands that transfer many files (fetch, resume, sync)"""
+    subparser.add_argument("--order", choices=["api", "largest", "smallest"], default="api",
+                           help="Start files as listed by EGA (api), largest first (finishes a run of mixed sizes "
+                                "soonest) or smallest first (most files done early) (default api)")
+    subparser.add_argument("--adaptive", action="store_true",
+                           help="Start with one file at a time and add concurrent transfers, up to the jobs "
+                                "setting, while they raise throughput")
 
 
 def main():
@@ -328,6 +2532,46 @@ def main():
 
     parser = argparse.ArgumentParser(description="Download from EMBL EBI's EGA (European Genome-phenome Archive")
     parser.add_argument("-d", "--debug", action="store_true", help="Extra debugging messages")
+    parser.add_argument("--base-url", default=os.environ.get("PYEGA_BASE_URL"),
+                        help="EGA REST API base URL (default {})".format(EGA_BASE_URL))
+    parser.add_argument("--s3-endpoint-url", default=os.environ.get("PYEGA_S3_ENDPOINT_URL"),
+                        help="S3 endpoint for sync, e.g. a local S3 stand-in (default: AWS)")
+    parser.add_argument("--pool-size", type=int, default=None,
+                        help="HTTP keep-alive connections to keep open (default: enough for all concurrent downloads)")
+    parser.add_argument("--timeout", type=float, default=HTTP_TIMEOUT[1],
+                        help="Seconds to wait for a reply from EGA before retrying (default {})".format(HTTP_TIMEOUT[1]))
+    parser.add_argument("--offline", action="store_true",
+                        help="Answer listing commands from the local cache only, without logging in")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached listings and fetch them again")
+    parser.add_argument("--cache-ttl", type=int, default=CACHE_TTL,
+                        help="Seconds a cached listing is reused; 0 disables the cache (default {})".format(CACHE_TTL))
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Listing cache directory (default {})".format(CACHE_DIR))
+    parser.add_argument("--cache-size", type=parse_size, default=CACHE_MAX_BYTES,
+                        help="Evict least recently used listings beyond this size, e.g. 64M")
+    parser.add_argument("--http-retries", type=int, default=HTTP_RETRIES,
+                        help="Retries of failed connections and 5xx replies, with backoff (default {})".format(
+                            HTTP_RETRIES))
+    parser.add_argument("--max-rate", type=parse_size, default=0,
+                        help="Cap on total download bandwidth, and on total sync upload bandwidth, in "
+                             "bytes/second, e.g. 50M (default: unlimited)")
+    parser.add_argument("--max-connection-rate", type=parse_size, default=0,
+                        help="Cap on each download connection and file upload in bytes/second, e.g. 10M "
+                             "(default: unlimited)")
+    parser.add_argument("--store", default=os.environ.get("PYEGA_STORE"),
+                        help="Keep downloaded files in this local object store (keyed by EGAF id and MD5) and link "
+                             "files already in it instead of downloading them again")
+    parser.add_argument("--store-size", type=parse_size, default=STORE_MAX_BYTES,
+                        help="Evict least recently used files from --store beyond this size, e.g. 2T")
+    parser.add_argument("--store-link", choices=["hardlink", "reflink", "copy"], default="hardlink",
+                        help="How files are linked between --store and output directories (default hardlink, "
+                             "falling back to reflink and copy across file systems)")
+    parser.add_argument("--report", help="Append a JSON-lines report of every login, listing, download, decrypt "
+                                         "and upload (bytes, seconds, retries, time queued) to this file")
+    parser.add_argument("--metrics-file",
+                        help="Keep per-stage totals in this Prometheus text file (e.g. for node_exporter's "
+                             "textfile collector), rewritten every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=int, default=METRICS_INTERVAL,
+                        help="Seconds between --metrics-file updates (default {})".format(METRICS_INTERVAL))
     # ArgumentParser.add_subparsers([title][, description][, prog][, parser_class][, action][, option_string][, dest][, help][, metavar])
     subparsers = parser.add_subparsers(dest="subcommand", help = "subcommands")
 
@@ -345,13 +2589,53 @@ def main():
     parser_files.add_argument("-l", "--label", default="", help="Optional request label")
 
     parser_fetch = subparsers.add_parser("fetch", help="Fetch a dataset or file")
-    parser_fetch.add_argument("identifier",
-                              help="Stable id for dataset (e.g. EGAD00000000001) or file (e.g. EGAF12345678901)")
-
-    parser_fetch = subparsers.add_parser("sync", help="Sync a dataset or file to a remote location")
-    parser_fetch.add_argument("identifier",
+    parser_fetch.add_argument("identifier", nargs="?",
                               help="Stable id for dataset (e.g. EGAD00000000001) or file (e.g. EGAF12345678901)")
-    parser_fetch.add_argument("destination", help="The sync target")
+    parser_fetch.add_argument("--manifest", help="File listing stable ids to fetch together, one per line")
+    add_download_arguments(parser_fetch)
+
+    parser_resume = subparsers.add_parser("resume", help="Resume an interrupted fetch of a request label")
+    parser_resume.add_argument("label", help="Request label of the fetch to resume")
+    add_download_arguments(parser_resume)
+
+    parser_sync = subparsers.add_parser("sync", help="Sync a dataset or file to a remote location")
+    parser_sync.add_argument("identifier", nargs="?",
+                             help="Stable id for dataset (e.g. EGAD00000000001) or file (e.g. EGAF12345678901)")
+    parser_sync.add_argument("destination", help="The sync target")
+    parser_sync.add_argument("--manifest", help="File listing stable ids to sync together, one per line")
+    parser_sync.add_argument("--chunk-size", type=int, default=DOWNLOAD_CHUNK_SIZE,
+                             help="Bytes buffered in memory per download stream (default {})".format(DOWNLOAD_CHUNK_SIZE))
+    parser_sync.add_argument("--segments", type=int, default=1,
+                             help="Download each large file as this many concurrent byte ranges")
+    parser_sync.add_argument("--stream", action="store_true",
+                             help="Pipe each file from EGA through in-process decryption straight into an S3 "
+                                  "multipart upload, without writing it to local disk")
+    parser_sync.add_argument("--part-size", type=int, default=STREAM_PART_SIZE,
+                             help="S3 multipart part size in bytes for --stream (default {})".format(STREAM_PART_SIZE))
+    parser_sync.add_argument("-j", "--download-jobs", type=int, default=1,
+                             help="Number of files to download (or stream) concurrently")
+    parser_sync.add_argument("--decrypt-jobs", type=int, default=1, help="Number of files to decrypt concurrently")
+    parser_sync.add_argument("--upload-jobs", type=int, default=1, help="Number of files to upload concurrently")
+    parser_sync.add_argument("--decryptor", choices=["auto", "python", "jar"], default="jar",
+                             help="Decrypt .cip files with EgaDemoClient.jar or in-process (python, needs "
+                                  "cryptography); auto uses python when available (default jar)")
+    parser_sync.add_argument("--jar-batch", type=int, default=1,
+                             help="Files handed to one EgaDemoClient.jar run at a time; set with --decrypt-jobs "
+                                  "to pay JVM startup once per batch")
+    parser_sync.add_argument("--retries", type=int, default=DOWNLOAD_RETRIES,
+                             help="Download retries per file before it is reported as failed (default {})".format(
+                                 DOWNLOAD_RETRIES))
+    parser_sync.add_argument("--scratch-budget", type=parse_size, default=None,
+                             help="Maximum local disk used by files in flight, e.g. 200G (default: unlimited)")
+    parser_sync.add_argument("--verify", action="store_true",
+                             help="Do not upload files whose MD5 does not match the listing (always checked and recorded)")
+    parser_sync.add_argument("--incremental", action="store_true",
+                             help="Only request files that are new or changed (by fileID, size and MD5) since the "
+                                  "last incremental sync to this destination, and delete the request label afterwards")
+    parser_sync.add_argument("--sync-manifest",
+                             help="Local path or s3:// URI of the --incremental manifest (default "
+                                  "<destination>/{})".format(SYNC_MANIFEST_NAME))
+    add_schedule_arguments(parser_sync)
 
     args = parser.parse_args()
     if args.debug:
@@ -359,10 +2643,65 @@ def main():
         debug = True
         print("[debugging]")
 
+    global api_url, download_api_url, s3_endpoint_url
+    if args.base_url:
+        api_url = args.base_url.rstrip('/') + "/access/v2"
+        download_api_url = args.base_url.rstrip('/') + "/ds/v2"
+    s3_endpoint_url = args.s3_endpoint_url
+
+    # Enough pooled connections for every concurrent download stream (files x byte range segments)
+    streams = max(getattr(args, 'jobs', 1), getattr(args, 'download_jobs', 1)) * getattr(args, 'segments', 1)
+    pool_size = args.pool_size or max(HTTP_POOL_SIZE, streams)
+    global bandwidth
+    bandwidth = Bandwidth(args.max_rate, args.max_connection_rate)
+
+    global telemetry
+    telemetry = Telemetry(args.report, args.metrics_file, args.metrics_interval)
+
+    global client
+    client = EgaClient(pool_size, (HTTP_TIMEOUT[0], args.timeout), args.http_retries)
+
+    if args.subcommand in ("fetch", "sync"):
+        identifiers = command_identifiers(args)
+
     (username, password, key) = load_credentials()
-    session = api_login(username, password)
-    if not session:
-        sys.exit(1)
+
+    global store
+    if args.store:
+        store = ObjectStore(args.store, args.store_size, key, args.store_link)
+
+    global cache
+    if args.cache_ttl > 0 or args.offline:
+        cache = ListingCache(args.cache_dir, username, args.cache_ttl, args.cache_size, args.offline, args.refresh)
+
+    if getattr(args, 'use_async', False):
+        if aiohttp is None:
+            print("--async requires the 'aiohttp' module (pip3 install aiohttp)")
+            sys.exit(1)
+        if args.adaptive:
+            print("--adaptive does not work with --async")
+            sys.exit(1)
+        if args.segments > 1:
+            print("--segments does not work with --async")
+            sys.exit(1)
+        failures = run_async(async_download_command(args, username, password, key,
+                                                    identifiers if args.subcommand == "fetch" else None, pool_size))
+        telemetry.close()
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.offline:
+        if args.subcommand not in ("datasets", "datasetinfo", "requests", "files"):
+            print("--offline only works with the datasets, datasetinfo, requests and files subcommands")
+            sys.exit(1)
+        session = None
+    else:
+        session = api_login(username, password)
+        if not session:
+            sys.exit(1)
+
+    failures = 0
 
     if args.subcommand == "datasets":
         reply = api_list_authorized_datasets(session)
@@ -387,49 +2726,62 @@ def main():
         pretty_print_files(list_reply)
 
     elif args.subcommand == "fetch":
-        if args.identifier[3] == 'D':
-            id_type = "datasets"
-        elif args.identifier[3] == 'F':
-            id_type = "files"
-        else:
-            print("Unrecognized identifier -- only datasets (EGAD...) and and files (EGAF...) supported")
-            sys.exit(1)
-
-        req_label = str(uuid.uuid4())
-        req_reply = api_make_request(session, id_type, args.identifier, req_label, key)
-
-        list_reply = api_list_requests(session, req_label)
-
-        # Save a copy of the request ticket
-        with open(req_label + ".json", "w+") as fo:
-            print("Writing copy of request ticket to {}".format(req_label + ".json"))
-            fo.write( json.dumps(list_reply) )
-        download_request(list_reply)
+        (req_label, list_reply) = request_identifiers(session, identifiers, key)
+        save_ticket_copy(req_label, list_reply)
+        journal = TransferJournal(req_label + ".journal.json")
+        verification = {}
+        failures = download_request(list_reply, args.chunk_size, args.jobs, args.retries, args.segments, journal,
+                                    verification, args.verify, args.order, args.adaptive, args.output_dir)
+        save_verification(req_label + ".verify.json", verification)
+
+    elif args.subcommand == "resume":
+        list_reply = load_ticket_copy(args.label) or api_list_requests(session, args.label)
+        journal = TransferJournal(args.label + ".journal.json")
+        verification = {}
+        failures = download_request(list_reply, args.chunk_size, args.jobs, args.retries, args.segments, journal,
+                                    verification, args.verify, args.order, args.adaptive, args.output_dir)
+        save_verification(args.label + ".verify.json", verification)
 
     elif args.subcommand == "sync":
         if not args.destination.startswith('s3://'):
             raise Exception('Error - sync destination must be an s3:// URI')
 
-        if args.identifier[3] == 'D':
-            id_type = "datasets"
-        elif args.identifier[3] == 'F':
-            id_type = "files"
+        if args.incremental:
+            manifest = SyncManifest(args.sync_manifest or sync_manifest_location(args.destination)).load()
+            if manifest.labels:
+                print("Deleting {} request labels left by earlier runs".format(len(manifest.labels)))
+                delete_request_labels(session, manifest, list(manifest.labels))
+            (req_label, list_reply, resend) = request_changed_files(session, identifiers, args.destination, key,
+                                                                    manifest)
         else:
-            print("Unrecognized identifier -- only datasets (EGAD...) and and files (EGAF...) supported")
-            sys.exit(1)
+            (req_label, list_reply) = request_identifiers(session, identifiers, key)
+            resend = None
 
-        req_label = str(uuid.uuid4())
-        req_reply = api_make_request(session, id_type, args.identifier, req_label, key)
-
-        list_reply = api_list_requests(session, req_label)
-
-        # Save a copy of the request ticket
-        with open(req_label + ".json", "w+") as fo:
-            print("Writing copy of request ticket to {}".format(req_label + ".json"))
-            fo.write( json.dumps(list_reply) )
-        sync_request(list_reply, args.destination, username, password, key)
-
-    api_logout(session)
+        if req_label is None:
+            print("Nothing new to sync")
+        else:
+            save_ticket_copy(req_label, list_reply)
+            verification = {}
+            synced = {}
+            failures = sync_request(list_reply, args.destination, username, password, key, args.chunk_size,
+                                    args.segments, args.stream, args.part_size,
+                                    (args.download_jobs, args.decrypt_jobs, args.upload_jobs), args.retries,
+                                    args.scratch_budget, verification, args.verify, args.decryptor, args.jar_batch,
+                                    args.order, args.adaptive, synced, resend)
+            save_verification(req_label + ".verify.json", verification)
+
+            if args.incremental:
+                # Failed files stay out of the manifest, so the next run requests them again
+                for res in list_reply['response']['result']:
+                    if res['fileID'] in synced:
+                        manifest.record(res, synced[res['fileID']])
+                delete_request_labels(session, manifest, [req_label])
+
+    if session:
+        api_logout(session)
+    telemetry.close()
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
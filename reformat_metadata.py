@@ -1,8 +1,11 @@
 import argparse
 import csv
+import json
 import logging
 from logging import config as logger_config
+import multiprocessing
 import os
+import tempfile
 import xml.etree.ElementTree as ET
 
 
@@ -18,34 +21,132 @@ def main():
     logger = logging.getLogger('genopheno')
     logger.debug('Parsing command-line arguments')
 
-    input_dir, output_file = parse_args()
+    input_dir, output_file, stream, workers = parse_args()
+
+    if stream:
+        logger.debug('Streaming samples through a spill file')
+        reformat_streaming(input_dir, output_file, workers)
+        return
 
     samples = []
     keys = set()
 
+    logger.debug('Parsing sample XMLs with %d worker(s)', workers)
+    for file_samples, file_keys in parse_sample_files(sample_xml_files(input_dir), workers):
+        keys |= file_keys
+        samples.extend(file_samples)
+
+    # Submitter IDs can repeat; as with a linear scan, files are attached to the first sample with the ID
+    samples_by_id = {}
+    for item in samples:
+        samples_by_id.setdefault(item.get('Submitter ID'), item)
+
+    for submitter_id, files in read_sample_file_map(input_dir).items():
+        item = samples_by_id.get(submitter_id)
+        if item is not None:
+            item['files'].extend(files)
+
+    keys = list(keys)
+    keys.sort()
+
+    with open(output_file, 'w') as oh:
+        handle = csv.DictWriter(oh, keys)
+        handle.writeheader()
+        handle.writerows(samples)
+
+
+def sample_xml_files(input_dir):
+    """
+    Find the sample XML files of a metadata package
+    :param input_dir: the path to the metadata directory
+    :return: generator of file paths, in os.walk order
+    """
     for root, subdirs, files in os.walk(input_dir):
         if root.endswith('/xmls/samples'):
             for f in files:
-                tree = ET.parse(os.path.join(root, f))
-                xml_root = tree.getroot()
+                yield os.path.join(root, f)
 
-                for child in xml_root:
-                    new_sample = child.attrib
-                    new_sample['files'] = []
-                    for ident in child.findall('IDENTIFIERS'):
-                        new_sample['Primary Identifier'] = ident.find('PRIMARY_ID').text
-                        new_sample['Submitter ID'] = ident.find('SUBMITTER_ID').text
 
-                    for sample_name in child.findall('SAMPLE_NAME'):
-                        new_sample['Organism'] = sample_name.find('COMMON_NAME').text
+def parse_sample(child):
+    """
+    Flatten a SAMPLE element into a dict of its attributes, identifiers, organism and sample attributes
+    :param child: the SAMPLE element
+    :return: dict with an empty 'files' list, filled in from Sample_File.map later
+    """
+    new_sample = dict(child.attrib)
+    new_sample['files'] = []
+    for ident in child.findall('IDENTIFIERS'):
+        new_sample['Primary Identifier'] = ident.find('PRIMARY_ID').text
+        new_sample['Submitter ID'] = ident.find('SUBMITTER_ID').text
 
-                    for sample in child.findall('SAMPLE_ATTRIBUTES'):
-                        for attr in sample.findall('SAMPLE_ATTRIBUTE'):
-                            new_sample[attr.find('TAG').text] = attr.find('VALUE').text
+    for sample_name in child.findall('SAMPLE_NAME'):
+        new_sample['Organism'] = sample_name.find('COMMON_NAME').text
 
-                    keys |= set(new_sample.keys())
-                    samples.append(new_sample)
+    for sample in child.findall('SAMPLE_ATTRIBUTES'):
+        for attr in sample.findall('SAMPLE_ATTRIBUTE'):
+            new_sample[attr.find('TAG').text] = attr.find('VALUE').text
+
+    return new_sample
+
+
+def parse_sample_file(path):
+    """
+    Parse all samples of one XML file
+    :param path: the path to the sample XML file
+    :return: tuple of list of sample dicts (see parse_sample), set of their keys
+    """
+    samples = []
+    keys = set()
+    for child in ET.parse(path).getroot():
+        new_sample = parse_sample(child)
+        keys |= set(new_sample.keys())
+        samples.append(new_sample)
+    return samples, keys
+
+
+def parse_sample_files(paths, workers=1):
+    """
+    Parse sample XML files, spread over a pool of worker processes if workers > 1
+    :param paths: the paths to the sample XML files
+    :param workers: the number of processes to parse with
+    :return: generator of parse_sample_file() results, in the order of paths whatever the number of workers
+    """
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for result in pool.imap(parse_sample_file, paths):
+                yield result
+    else:
+        for path in paths:
+            yield parse_sample_file(path)
 
+
+def iter_samples(path):
+    """
+    Parse the samples of one XML file incrementally, discarding each element once it has been handled
+    :param path: the path to the sample XML file
+    :return: generator of sample dicts (see parse_sample)
+    """
+    depth = 0
+    xml_root = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if xml_root is None:
+                xml_root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield parse_sample(elem)
+                xml_root.clear()
+
+
+def read_sample_file_map(input_dir):
+    """
+    Read delimited_maps/Sample_File.map, if the metadata package has one
+    :param input_dir: the path to the metadata directory
+    :return: dict of Submitter ID to the list of its file dicts, in file order
+    """
+    files_by_id = {}
     map_file = os.path.join(input_dir, 'delimited_maps', 'Sample_File.map')
     if os.path.exists(map_file):
         with open(map_file, 'r') as fh:
@@ -57,31 +158,63 @@ def main():
                     'file_name': parts[2],
                     'file_accession': parts[3]
                 }
+                files_by_id.setdefault(new_dict['Submitter ID'], []).append(new_dict)
 
-                for item in samples:
-                    if item['Submitter ID'] == new_dict['Submitter ID']:
-                        item['files'].append(new_dict)
-                        break
+    return files_by_id
 
-    keys = list(keys)
-    keys.sort()
 
-    with open(output_file, 'w') as oh:
-        handle = csv.DictWriter(oh, keys)
-        handle.writeheader()
-        handle.writerows(samples)
+def reformat_streaming(input_dir, output_file, workers=1):
+    """
+    Write the same CSV as main() while holding only one sample in memory at a time
+
+    The XMLs are parsed once with iterparse; samples are spilled to a temporary
+    JSON-lines file while the column set csv.DictWriter needs is collected, then
+    read back and written out one row at a time. With workers > 1 whole files are
+    parsed in worker processes instead, so memory is bounded by the files in flight.
+    :param input_dir: the path to the metadata directory
+    :param output_file: the path to write the reformatted output to
+    :param workers: the number of processes to parse with
+    """
+    keys = set()
+    with tempfile.TemporaryFile('w+') as spill:
+        if workers > 1:
+            for file_samples, file_keys in parse_sample_files(sample_xml_files(input_dir), workers):
+                keys |= file_keys
+                for new_sample in file_samples:
+                    spill.write(json.dumps(new_sample) + '\n')
+        else:
+            for path in sample_xml_files(input_dir):
+                for new_sample in iter_samples(path):
+                    keys |= set(new_sample.keys())
+                    spill.write(json.dumps(new_sample) + '\n')
+
+        # Only the first sample with a given Submitter ID gets its files, as in main()
+        files_by_id = read_sample_file_map(input_dir)
+
+        spill.seek(0)
+        with open(output_file, 'w') as oh:
+            handle = csv.DictWriter(oh, sorted(keys))
+            handle.writeheader()
+            for line in spill:
+                new_sample = json.loads(line)
+                new_sample['files'] = files_by_id.pop(new_sample.get('Submitter ID'), [])
+                handle.writerow(new_sample)
 
 
 def parse_args():
     """
     Parse the command-line arguments and extract the input directory and output file
-    :return: tuple of input directory, output file
+    :return: tuple of input directory, output file, whether to stream, number of worker processes
     """
     parser = argparse.ArgumentParser(description="Reformat XML metadata to a .csv file")
     parser.add_argument('-i', '--input_dir', help='The path to the metadata directory', type=str,
                         dest='input_dir', required=True)
     parser.add_argument('-u', '--outputfile', help='The path to write the reformatted output to', type=str,
                         dest='outputfile', default=None, required=True)
+    parser.add_argument('-s', '--stream', help='Parse incrementally with bounded memory, for very large metadata',
+                        action='store_true', dest='stream')
+    parser.add_argument('-w', '--workers', help='The number of processes to parse sample XMLs with', type=int,
+                        dest='workers', default=1)
 
     args = parser.parse_args()
 
@@ -93,7 +226,7 @@ def parse_args():
     if not os.path.exists(os.path.dirname(args.outputfile)):
         os.makedirs(os.path.dirname(args.outputfile), 0o770)
 
-    return args.input_dir, args.outputfile
+    return args.input_dir, args.outputfile, args.stream, args.workers
 
 
 if __name__ == "__main__":
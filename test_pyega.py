@@ -0,0 +1,164 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import boto3
+
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto < 5
+    from moto import mock_s3 as mock_aws
+
+import mock_ega_server
+import pyega
+
+
+def listing(name, size):
+    return {'fileID': 'EGAF00000000001', 'fileName': '/EGAR00000000001/' + name, 'fileSize': str(size),
+            'fileMD5': '0' * 32, 'ticket': 'ticket'}
+
+
+class TestS3Inventory(unittest.TestCase):
+    """Skip decisions of sync against a moto S3 bucket"""
+
+    def setUp(self):
+        os.environ.update(AWS_ACCESS_KEY_ID='test', AWS_SECRET_ACCESS_KEY='test', AWS_DEFAULT_REGION='us-east-1')
+        self.mock = mock_aws()
+        self.mock.start()
+        self.bucket = boto3.resource('s3', region_name='us-east-1').Bucket('pyega-test')
+        self.bucket.create()
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_inventory_lists_prefix(self):
+        self.bucket.put_object(Key='sync/a.bam', Body=b'x' * 10)
+        self.bucket.put_object(Key='sync/b.bam', Body=b'x' * 20)
+        self.bucket.put_object(Key='other/c.bam', Body=b'x')
+
+        inventory = pyega.list_s3_inventory(self.bucket, 'sync/')
+        self.assertEqual(sorted(inventory), ['sync/a.bam', 'sync/b.bam'])
+        self.assertEqual(inventory['sync/b.bam'][0], 20)
+
+    def test_plain_file(self):
+        self.bucket.put_object(Key='sync/a.bam', Body=b'x' * 10)
+        inventory = pyega.list_s3_inventory(self.bucket, 'sync/')
+
+        self.assertTrue(pyega.is_synced(inventory, 'sync/a.bam', pyega.expected_upload_size(listing('a.bam', 10))))
+        self.assertFalse(pyega.is_synced(inventory, 'sync/b.bam', pyega.expected_upload_size(listing('b.bam', 10))))
+
+    def test_truncated_object(self):
+        self.bucket.put_object(Key='sync/a.bam', Body=b'x' * 6)
+        self.bucket.put_object(Key='sync/c.bam', Body=b'x' * 6)
+        inventory = pyega.list_s3_inventory(self.bucket, 'sync/')
+
+        self.assertFalse(pyega.is_synced(inventory, 'sync/a.bam', pyega.expected_upload_size(listing('a.bam', 10))))
+        # .cip files are uploaded decrypted, at the listed (unencrypted) size
+        self.assertFalse(pyega.is_synced(inventory, 'sync/c.bam',
+                                         pyega.expected_upload_size(listing('c.bam.cip', 10))))
+        self.assertTrue(pyega.is_synced(inventory, 'sync/c.bam', pyega.expected_upload_size(listing('c.bam.cip', 6))))
+
+
+class TestUploadConfig(unittest.TestCase):
+    """Part sizes of sync uploads from local disk"""
+
+    def test_small_file(self):
+        self.assertEqual(pyega.upload_config(1024).multipart_chunksize, pyega.UPLOAD_PART_SIZE)
+
+    def test_part_limit(self):
+        size = 200 * 1024 ** 3
+        part_size = pyega.upload_config(size).multipart_chunksize
+        self.assertGreater(part_size, pyega.UPLOAD_PART_SIZE)
+        self.assertLessEqual(-(-size // part_size), pyega.S3_MAX_PARTS)
+
+
+class TestIncrementalSync(unittest.TestCase):
+    """sync --incremental against the mock EGA server and a moto S3 bucket"""
+
+    def setUp(self):
+        os.environ.update(AWS_ACCESS_KEY_ID='test', AWS_SECRET_ACCESS_KEY='test', AWS_DEFAULT_REGION='us-east-1')
+        self.mock = mock_aws()
+        self.mock.start()
+        self.bucket = boto3.resource('s3', region_name='us-east-1').Bucket('pyega-test')
+        self.bucket.create()
+
+        mock_ega_server.MockEgaHandler.ega = mock_ega_server.MockEga(nfiles=3, file_size=64 * 1024)
+        mock_ega_server.MockEgaHandler.options = mock_ega_server.parse_args([])
+        self.server = mock_ega_server.ThreadingHTTPServer(('127.0.0.1', 0), mock_ega_server.MockEgaHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix='pyega_test_')
+        os.chdir(self.work_dir)
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.work_dir
+        with open('.ega.json', 'w') as fo:
+            json.dump({'username': 'test', 'password': 'test', 'key': 'testkey'}, fo)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        if self.home is not None:
+            os.environ['HOME'] = self.home
+        shutil.rmtree(self.work_dir)
+        self.mock.stop()
+
+    def sync(self):
+        """Run pyega.py sync --incremental; returns its output"""
+        argv = ['pyega.py', '--base-url', 'http://127.0.0.1:{}/ega/rest'.format(self.server.server_address[1]),
+                '--cache-ttl', '0', 'sync', 'EGAD00000000001', 's3://pyega-test/sync', '--incremental', '--verify']
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            old_argv = sys.argv
+            sys.argv = argv
+            try:
+                pyega.main()
+            finally:
+                sys.argv = old_argv
+        return output.getvalue()
+
+    def object_md5(self, key):
+        return hashlib.md5(self.bucket.Object(key).get()['Body'].read()).hexdigest()
+
+    def test_unchanged_dataset_is_not_requested(self):
+        self.sync()
+        self.assertIn("Nothing new to sync", self.sync())
+
+    def test_changed_md5_is_sent_again(self):
+        self.sync()
+        ega = mock_ega_server.MockEgaHandler.ega
+        old_md5 = ega.files['EGAF00000000001'].md5()
+        self.assertEqual(self.object_md5('sync/sample_0.bam'), old_md5)
+
+        # Same sizes, different contents
+        mock_ega_server.MockEgaHandler.ega = mock_ega_server.MockEga(nfiles=3, file_size=64 * 1024, seed=7)
+        new_md5 = mock_ega_server.MockEgaHandler.ega.files['EGAF00000000001'].md5()
+        self.assertNotEqual(new_md5, old_md5)
+
+        output = self.sync()
+        self.assertIn("3 of 3 files new or changed", output)
+        self.assertIn("Synced 3 of 3 files", output)
+        self.assertEqual(self.object_md5('sync/sample_0.bam'), new_md5)
+        self.assertIn("Nothing new to sync", self.sync())
+
+    def test_truncated_object_is_sent_again(self):
+        self.sync()
+        md5 = self.object_md5('sync/sample_1.bam')
+        self.bucket.put_object(Key='sync/sample_1.bam', Body=b'x' * 10)
+
+        output = self.sync()
+        self.assertIn("1 of 3 files new or changed", output)
+        self.assertEqual(self.object_md5('sync/sample_1.bam'), md5)
+
+
+if __name__ == "__main__":
+    unittest.main()